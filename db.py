@@ -3,36 +3,63 @@ import pymysql
 from dotenv import load_dotenv
 import logging
 import json
+from datetime import date, datetime
+
+from tenants import current_db_name
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def get_connection():
-    """Create and return a database connection."""
+def get_connection(timeout=None):
+    """
+    Create and return a database connection.
+    timeout: seconds allowed for connecting and for each read/write (default: no read/write limit).
+    """
     try:
         connection = pymysql.connect(
             host=os.getenv('DB_HOST', 'localhost'),
             port=int(os.getenv('DB_PORT', 3306)),
             user=os.getenv('DB_USER', 'root'),
             password=os.getenv('DB_PASSWORD', ''),
-            database=os.getenv('DB_NAME', '工程信息'),
+            # Target database of the active tenant (DB_NAME unless TENANTS_FILE says otherwise)
+            database=current_db_name(),
             charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
+            cursorclass=pymysql.cursors.DictCursor,
+            connect_timeout=timeout or 10,
+            read_timeout=timeout,
+            write_timeout=timeout
         )
         return connection
     except Exception as e:
         logger.error(f"Error connecting to database: {e}")
         raise
 
+# Bump whenever the DDL/migrations in create_table_if_not_exists() change.
+SCHEMA_VERSION = 7
+
+def get_schema_version(cursor):
+    """Return the schema version recorded in `schema_meta`, 0 if not recorded yet."""
+    try:
+        cursor.execute("SELECT version FROM `schema_meta` WHERE id = 1")
+    except pymysql.err.ProgrammingError:
+        # Table doesn't exist yet
+        return 0
+    row = cursor.fetchone()
+    return row['version'] if row else 0
+
 def create_table_if_not_exists():
-    """Create the process_instance and dingtalk_user tables if they don't exist."""
+    """
+    Create the tables if they don't exist and apply migrations.
+    Skipped (a single SELECT) when `schema_meta` already records SCHEMA_VERSION.
+    """
     conn = get_connection()
     try:
         with conn.cursor() as cursor:
+            if get_schema_version(cursor) >= SCHEMA_VERSION:
+                return
+
             # 1. Create process_instance table
             create_pi_sql = """
             CREATE TABLE IF NOT EXISTS `process_instance` (
@@ -80,6 +107,18 @@ def create_table_if_not_exists():
                 logger.info("Adding column `form_values_cleaned` to process_instance...")
                 cursor.execute("ALTER TABLE `process_instance` ADD COLUMN `form_values_cleaned` JSON COMMENT 'Cleaned Form Data' AFTER `tasks`")
 
+            # Index used by the reconcile sweep (in-flight instances, oldest sync first)
+            cursor.execute("SHOW INDEX FROM `process_instance` WHERE Key_name = 'idx_status_update_time'")
+            if not cursor.fetchone():
+                logger.info("Adding index `idx_status_update_time` to process_instance...")
+                cursor.execute("ALTER TABLE `process_instance` ADD KEY `idx_status_update_time` (`status`, `update_time`)")
+
+            # Index used by incremental exports (rows changed since the last run)
+            cursor.execute("SHOW INDEX FROM `process_instance` WHERE Key_name = 'idx_update_time'")
+            if not cursor.fetchone():
+                logger.info("Adding index `idx_update_time` to process_instance...")
+                cursor.execute("ALTER TABLE `process_instance` ADD KEY `idx_update_time` (`update_time`)")
+
             # 2. Create dingtalk_user table
             create_user_sql = """
             CREATE TABLE IF NOT EXISTS `dingtalk_user` (
@@ -91,15 +130,169 @@ def create_table_if_not_exists():
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='DingTalk Users Cache';
             """
             cursor.execute(create_user_sql)
+
+            # 3. Create event_outbox table (durable buffer for stream events)
+            create_outbox_sql = """
+            CREATE TABLE IF NOT EXISTS `event_outbox` (
+                `process_instance_id` VARCHAR(64) NOT NULL COMMENT 'Process Instance ID',
+                `event_type` VARCHAR(64) COMMENT 'Last Received Event Type',
+                `status` VARCHAR(16) NOT NULL DEFAULT 'PENDING' COMMENT 'Status: PENDING, PROCESSING, FAILED (done rows are deleted)',
+                `seq` INT NOT NULL DEFAULT 1 COMMENT 'Bumped on every event for this instance',
+                `attempts` INT NOT NULL DEFAULT 0 COMMENT 'Failed Processing Attempts',
+                `last_error` VARCHAR(512) COMMENT 'Last Processing Error',
+                `next_attempt_at` DATETIME COMMENT 'Not claimed before this time (retry backoff)',
+                `claimed_at` DATETIME COMMENT 'When a worker claimed it (lease start)',
+                `create_time` DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT 'First Received Time',
+                `update_time` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'Last Change Time',
+                PRIMARY KEY (`process_instance_id`),
+                KEY `idx_status_update_time` (`status`, `update_time`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Stream Event Outbox';
+            """
+            cursor.execute(create_outbox_sql)
+
+            cursor.execute("SHOW COLUMNS FROM `event_outbox` LIKE 'next_attempt_at'")
+            if not cursor.fetchone():
+                logger.info("Adding column `next_attempt_at` to event_outbox...")
+                cursor.execute("ALTER TABLE `event_outbox` ADD COLUMN `next_attempt_at` DATETIME COMMENT 'Not claimed before this time (retry backoff)' AFTER `last_error`")
+
+            cursor.execute("SHOW COLUMNS FROM `event_outbox` LIKE 'claimed_at'")
+            if not cursor.fetchone():
+                logger.info("Adding column `claimed_at` to event_outbox...")
+                cursor.execute("ALTER TABLE `event_outbox` ADD COLUMN `claimed_at` DATETIME COMMENT 'When a worker claimed it (lease start)' AFTER `next_attempt_at`")
+
+            # 4. Create dingtalk_token table (access token shared across processes)
+            create_token_sql = """
+            CREATE TABLE IF NOT EXISTS `dingtalk_token` (
+                `app_key` VARCHAR(64) NOT NULL COMMENT 'DingTalk AppKey',
+                `access_token` VARCHAR(128) COMMENT 'Access Token',
+                `expires_at` DOUBLE NOT NULL DEFAULT 0 COMMENT 'Expiry (epoch seconds)',
+                `update_time` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'Last Refresh Time',
+                PRIMARY KEY (`app_key`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Shared DingTalk Access Token';
+            """
+            cursor.execute(create_token_sql)
+
+            # 5. Create sync_retry and sync_dead_letter tables (failed instance syncs)
+            create_retry_sql = """
+            CREATE TABLE IF NOT EXISTS `sync_retry` (
+                `process_instance_id` VARCHAR(64) NOT NULL COMMENT 'Process Instance ID',
+                `reason` VARCHAR(512) COMMENT 'Last Failure Reason',
+                `attempts` INT NOT NULL DEFAULT 1 COMMENT 'Failed Attempts',
+                `next_retry_at` DATETIME NOT NULL COMMENT 'Next Retry Time (exponential backoff)',
+                `create_time` DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT 'First Failure Time',
+                `update_time` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'Last Failure Time',
+                PRIMARY KEY (`process_instance_id`),
+                KEY `idx_next_retry_at` (`next_retry_at`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Failed Instance Syncs Pending Retry';
+            """
+            cursor.execute(create_retry_sql)
+
+            create_dead_letter_sql = """
+            CREATE TABLE IF NOT EXISTS `sync_dead_letter` (
+                `process_instance_id` VARCHAR(64) NOT NULL COMMENT 'Process Instance ID',
+                `reason` VARCHAR(512) COMMENT 'Last Failure Reason',
+                `attempts` INT NOT NULL COMMENT 'Failed Attempts',
+                `first_failed_at` DATETIME COMMENT 'First Failure Time',
+                `dead_time` DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT 'Time Parked',
+                PRIMARY KEY (`process_instance_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Instance Syncs That Exhausted Retries';
+            """
+            cursor.execute(create_dead_letter_sql)
+
+            # 6. Create process_instance_archive table (finished instances moved out by `archive`)
+            create_archive_sql = """
+            CREATE TABLE IF NOT EXISTS `process_instance_archive` (
+                `process_instance_id` VARCHAR(64) NOT NULL COMMENT 'Process Instance ID',
+                `title` VARCHAR(255) COMMENT 'Approval Title',
+                `create_time` DATETIME COMMENT 'Creation Time',
+                `finish_time` DATETIME COMMENT 'Finish Time',
+                `originator_userid` VARCHAR(64) COMMENT 'Originator User ID',
+                `originator_dept_id` VARCHAR(64) COMMENT 'Originator Dept ID',
+                `status` VARCHAR(32) COMMENT 'Status: COMPLETED, TERMINATED',
+                `result` VARCHAR(32) COMMENT 'Result: agree, refuse, etc.',
+                `business_id` VARCHAR(128) COMMENT 'Business ID',
+                `process_code` VARCHAR(64) COMMENT 'Process Code (Template ID)',
+                `form_component_values` JSON COMMENT 'Full Form Data',
+                `originator_name` VARCHAR(64) COMMENT 'Originator Name',
+                `current_approvers` VARCHAR(512) COMMENT 'Current Approvers Names',
+                `update_time` DATETIME COMMENT 'Last Sync Time',
+                `tasks` JSON COMMENT 'Raw Tasks List',
+                `form_values_cleaned` JSON COMMENT 'Cleaned Form Data',
+                `archived_time` DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT 'Archive Time',
+                PRIMARY KEY (`process_instance_id`),
+                KEY `idx_create_time` (`create_time`),
+                KEY `idx_process_code` (`process_code`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8
+            COMMENT='Archived (finished) DingTalk Process Instances';
+            """
+            cursor.execute(create_archive_sql)
+
+            # 7. Record applied schema version
+            create_meta_sql = """
+            CREATE TABLE IF NOT EXISTS `schema_meta` (
+                `id` TINYINT NOT NULL COMMENT 'Always 1',
+                `version` INT NOT NULL COMMENT 'Applied Schema Version',
+                `update_time` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'Last Migration Time',
+                PRIMARY KEY (`id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Schema Version';
+            """
+            cursor.execute(create_meta_sql)
+            cursor.execute(
+                "INSERT INTO `schema_meta` (`id`, `version`) VALUES (1, %s) AS new "
+                "ON DUPLICATE KEY UPDATE `version` = new.version",
+                (SCHEMA_VERSION,)
+            )
                 
         conn.commit()
-        logger.info("Tables checked/created successfully.")
+        logger.info(f"Tables checked/created successfully (schema version {SCHEMA_VERSION}).")
     except Exception as e:
         logger.error(f"Error creating/updating tables: {e}")
         raise
     finally:
         conn.close()
 
+# Final instance states; a row in one of them is never downgraded by a stale write
+# (e.g. a spooled RUNNING snapshot replayed after another process stored COMPLETED).
+FINAL_STATUSES = ('COMPLETED', 'TERMINATED')
+_KEEP_FINAL = (
+    f"`status` IN ({', '.join(repr(s) for s in FINAL_STATUSES)}) "
+    f"AND new.status NOT IN ({', '.join(repr(s) for s in FINAL_STATUSES)})"
+)
+
+# `status` is assigned last: MySQL applies the assignments left to right, so
+# the guard on the other columns must still see the stored status.
+PROCESS_INSTANCE_UPSERT_SQL = f"""
+INSERT INTO `process_instance` (
+    `process_instance_id`, `title`, `create_time`, `finish_time`,
+    `originator_userid`, `originator_dept_id`, `status`, `result`,
+    `business_id`, `process_code`, `form_component_values`,
+    `originator_name`, `current_approvers`, `tasks`, `form_values_cleaned`
+) VALUES (
+    %(process_instance_id)s, %(title)s, %(create_time)s, %(finish_time)s,
+    %(originator_userid)s, %(originator_dept_id)s, %(status)s, %(result)s,
+    %(business_id)s, %(process_code)s, %(form_component_values)s,
+    %(originator_name)s, %(current_approvers)s, %(tasks)s, %(form_values_cleaned)s
+) AS new
+ON DUPLICATE KEY UPDATE
+    `title` = IF({_KEEP_FINAL}, `title`, new.title),
+    `finish_time` = IF({_KEEP_FINAL}, `finish_time`, new.finish_time),
+    `result` = IF({_KEEP_FINAL}, `result`, new.result),
+    `form_component_values` = IF({_KEEP_FINAL}, `form_component_values`, new.form_component_values),
+    `originator_name` = IF({_KEEP_FINAL}, `originator_name`, new.originator_name),
+    `current_approvers` = IF({_KEEP_FINAL}, `current_approvers`, new.current_approvers),
+    `tasks` = IF({_KEEP_FINAL}, `tasks`, new.tasks),
+    `form_values_cleaned` = IF({_KEEP_FINAL}, `form_values_cleaned`, new.form_values_cleaned),
+    `status` = IF({_KEEP_FINAL}, `status`, new.status),
+    `update_time` = NOW();
+"""
+
+def _serialize_json_fields(data):
+    """Ensure JSON fields are serialized if passed as dict/list."""
+    for field in ('form_component_values', 'tasks', 'form_values_cleaned'):
+        if isinstance(data.get(field), (dict, list)):
+            data[field] = json.dumps(data[field], ensure_ascii=False)
+    return data
+
 def upsert_process_instance(data):
     """
     Upsert a single process instance record.
@@ -108,45 +301,12 @@ def upsert_process_instance(data):
     if not data:
         return
 
-    # Ensure JSON fields are serialized if passed as dict/list
-    if isinstance(data.get('form_component_values'), (dict, list)):
-        data['form_component_values'] = json.dumps(data['form_component_values'], ensure_ascii=False)
-    
-    if isinstance(data.get('tasks'), (dict, list)):
-        data['tasks'] = json.dumps(data['tasks'], ensure_ascii=False)
-        
-    if isinstance(data.get('form_values_cleaned'), (dict, list)):
-        data['form_values_cleaned'] = json.dumps(data.get('form_values_cleaned'), ensure_ascii=False)
-
-    upsert_sql = """
-    INSERT INTO `process_instance` (
-        `process_instance_id`, `title`, `create_time`, `finish_time`,
-        `originator_userid`, `originator_dept_id`, `status`, `result`,
-        `business_id`, `process_code`, `form_component_values`,
-        `originator_name`, `current_approvers`, `tasks`, `form_values_cleaned`
-    ) VALUES (
-        %(process_instance_id)s, %(title)s, %(create_time)s, %(finish_time)s,
-        %(originator_userid)s, %(originator_dept_id)s, %(status)s, %(result)s,
-        %(business_id)s, %(process_code)s, %(form_component_values)s,
-        %(originator_name)s, %(current_approvers)s, %(tasks)s, %(form_values_cleaned)s
-    ) AS new
-    ON DUPLICATE KEY UPDATE
-        `title` = new.title,
-        `finish_time` = new.finish_time,
-        `status` = new.status,
-        `result` = new.result,
-        `form_component_values` = new.form_component_values,
-        `originator_name` = new.originator_name,
-        `current_approvers` = new.current_approvers,
-        `tasks` = new.tasks,
-        `form_values_cleaned` = new.form_values_cleaned,
-        `update_time` = NOW();
-    """
+    _serialize_json_fields(data)
 
     conn = get_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute(upsert_sql, data)
+            cursor.execute(PROCESS_INSTANCE_UPSERT_SQL, data)
         conn.commit()
         # logger.info(f"Successfully upserted process instance {data.get('process_instance_id')}")
     except Exception as e:
@@ -155,6 +315,30 @@ def upsert_process_instance(data):
     finally:
         conn.close()
 
+def upsert_process_instances(records, timeout=None):
+    """
+    Batch upsert process instance records in one transaction.
+    records: List of record dicts (same shape as upsert_process_instance).
+    timeout: optional DB timeout in seconds (see get_connection).
+    """
+    if not records:
+        return
+
+    for data in records:
+        _serialize_json_fields(data)
+
+    conn = get_connection(timeout)
+    try:
+        with conn.cursor() as cursor:
+            cursor.executemany(PROCESS_INSTANCE_UPSERT_SQL, records)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error batch upserting {len(records)} process instances: {e}")
+        raise
+    finally:
+        conn.close()
+
 def upsert_dingtalk_users(users):
     """
     Batch upsert dingtalk users.
@@ -204,9 +388,28 @@ def get_user_name_from_db(userid):
         conn.close()
     return None
 
+def get_user_names_from_db(userids):
+    """
+    Batch version of get_user_name_from_db.
+    Returns: dict {userid: name} for the users found in the cache table.
+    Raises on DB errors, so callers can tell "not cached" from "cache unreadable".
+    """
+    userids = [u for u in set(userids) if u]
+    if not userids:
+        return {}
+
+    placeholders = ",".join(["%s"] * len(userids))
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT userid, name FROM `dingtalk_user` WHERE userid IN ({placeholders})", userids)
+            return {r['userid']: r['name'] for r in cursor.fetchall() if r['name']}
+    finally:
+        conn.close()
+
 def get_instance_status(process_instance_id):
     """
-    Check if an instance exists and return its status.
+    Check if an instance exists (hot or archived) and return its status.
     Returns: status string (e.g. 'COMPLETED', 'RUNNING') or None if not found.
     """
     if not process_instance_id:
@@ -215,7 +418,11 @@ def get_instance_status(process_instance_id):
     conn = get_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT status FROM `process_instance` WHERE process_instance_id = %s", (process_instance_id,))
+            cursor.execute(
+                "SELECT status FROM `process_instance` WHERE process_instance_id = %s "
+                "UNION ALL SELECT status FROM `process_instance_archive` WHERE process_instance_id = %s LIMIT 1",
+                (process_instance_id, process_instance_id)
+            )
             result = cursor.fetchone()
             if result:
                 return result['status']
@@ -224,3 +431,503 @@ def get_instance_status(process_instance_id):
     finally:
         conn.close()
     return None
+
+def get_instance_statuses(process_instance_ids):
+    """
+    Batch version of get_instance_status (hot and archived instances).
+    Returns: dict {process_instance_id: status} for the IDs that exist.
+    """
+    if not process_instance_ids:
+        return {}
+
+    ids = list(process_instance_ids)
+    placeholders = ",".join(["%s"] * len(ids))
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT process_instance_id, status FROM `process_instance` WHERE process_instance_id IN ({placeholders}) "
+                f"UNION ALL SELECT process_instance_id, status FROM `process_instance_archive` WHERE process_instance_id IN ({placeholders})",
+                ids + ids
+            )
+            return {r['process_instance_id']: r['status'] for r in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Error checking instance statuses: {e}")
+        raise
+    finally:
+        conn.close()
+
+def get_inflight_instance_ids(limit=500):
+    """
+    Return IDs of instances not yet in a final state (NEW/RUNNING),
+    least recently synced first. Instances waiting for a scheduled retry or
+    parked in the dead letter table are left out: a failed refresh doesn't touch
+    update_time, so they would otherwise head every sweep.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT p.process_instance_id FROM `process_instance` p "
+                "WHERE p.status IN ('NEW', 'RUNNING') "
+                "AND NOT EXISTS (SELECT 1 FROM `sync_retry` r "
+                "WHERE r.process_instance_id = p.process_instance_id AND r.next_retry_at > NOW()) "
+                "AND NOT EXISTS (SELECT 1 FROM `sync_dead_letter` d "
+                "WHERE d.process_instance_id = p.process_instance_id) "
+                "ORDER BY p.update_time LIMIT %s",
+                (limit,)
+            )
+            return [r['process_instance_id'] for r in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Error fetching in-flight instances: {e}")
+        raise
+    finally:
+        conn.close()
+
+# --- Event Outbox ---
+
+def enqueue_event(process_instance_id, event_type=None):
+    """
+    Durably record a stream event for an instance.
+    Several events for the same instance collapse into one pending row.
+    A row that is being processed stays claimed by its worker (no second worker
+    syncs the instance concurrently); `seq` is bumped so that worker requeues it
+    instead of completing it.
+    """
+    if not process_instance_id:
+        return
+
+    enqueue_sql = """
+    INSERT INTO `event_outbox` (`process_instance_id`, `event_type`)
+    VALUES (%s, %s)
+    AS new
+    ON DUPLICATE KEY UPDATE
+        `event_type` = new.event_type,
+        `status` = IF(`status` = 'PROCESSING', 'PROCESSING', 'PENDING'),
+        `seq` = `seq` + 1,
+        `attempts` = 0,
+        `last_error` = NULL,
+        `next_attempt_at` = NULL;
+    """
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(enqueue_sql, (process_instance_id, event_type))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error enqueuing event for {process_instance_id}: {e}")
+        raise
+    finally:
+        conn.close()
+
+def claim_pending_events(limit=10, lease_seconds=300):
+    """
+    Claim up to `limit` outbox rows: pending rows whose backoff has expired, and
+    PROCESSING rows whose lease (`lease_seconds` since claimed_at) ran out because
+    their worker died or could not record the outcome.
+    Returns: list of dicts {'process_instance_id': ..., 'seq': ..., 'attempts': ...}
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT process_instance_id, seq, attempts FROM `event_outbox` "
+                "WHERE (status = 'PENDING' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())) "
+                "OR (status = 'PROCESSING' AND (claimed_at IS NULL OR claimed_at < NOW() - INTERVAL %s SECOND)) "
+                "ORDER BY update_time LIMIT %s "
+                "FOR UPDATE SKIP LOCKED",
+                (lease_seconds, limit)
+            )
+            rows = cursor.fetchall()
+            if rows:
+                ids = [r['process_instance_id'] for r in rows]
+                placeholders = ",".join(["%s"] * len(ids))
+                cursor.execute(
+                    f"UPDATE `event_outbox` SET status = 'PROCESSING', claimed_at = NOW() "
+                    f"WHERE process_instance_id IN ({placeholders})",
+                    ids
+                )
+        conn.commit()
+        return list(rows)
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error claiming outbox events: {e}")
+        raise
+    finally:
+        conn.close()
+
+def complete_event(process_instance_id, seq):
+    """
+    Delete a processed event, or hand it back as PENDING if a newer
+    event arrived while it was being processed.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            deleted = cursor.execute(
+                "DELETE FROM `event_outbox` WHERE process_instance_id = %s AND seq = %s",
+                (process_instance_id, seq)
+            )
+            if not deleted:
+                cursor.execute(
+                    "UPDATE `event_outbox` SET status = 'PENDING' "
+                    "WHERE process_instance_id = %s AND status = 'PROCESSING'",
+                    (process_instance_id,)
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+def fail_event(process_instance_id, seq, error, max_attempts=5, base_delay=5, max_delay=300):
+    """
+    Record a failed attempt. The row goes back to PENDING, claimable again after
+    base_delay * 2^(attempts-1) seconds (capped at max_delay), until `max_attempts`
+    is reached; then it is parked as FAILED.
+    If a newer event arrived meanwhile, the row is requeued at once with a fresh count.
+    Returns: True if the row was parked as FAILED.
+    """
+    fail_sql = """
+    UPDATE `event_outbox` SET
+        `status` = IF(`seq` = %(seq)s AND `attempts` + 1 >= %(max_attempts)s, 'FAILED', 'PENDING'),
+        `last_error` = IF(`seq` = %(seq)s, %(error)s, NULL),
+        `next_attempt_at` = IF(`seq` = %(seq)s, NOW() + INTERVAL LEAST(%(base)s * POW(2, `attempts`), %(max)s) SECOND, NULL),
+        `attempts` = IF(`seq` = %(seq)s, `attempts` + 1, 0)
+    WHERE process_instance_id = %(pid)s AND status = 'PROCESSING';
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            # MySQL applies the assignments left to right: `attempts` must stay last
+            cursor.execute(fail_sql, {
+                'pid': process_instance_id,
+                'seq': seq,
+                'error': str(error)[:512],
+                'max_attempts': max_attempts,
+                'base': base_delay,
+                'max': max_delay,
+            })
+            cursor.execute("SELECT status FROM `event_outbox` WHERE process_instance_id = %s", (process_instance_id,))
+            row = cursor.fetchone()
+        conn.commit()
+        return bool(row) and row['status'] == 'FAILED'
+    finally:
+        conn.close()
+
+def purge_done_events():
+    """
+    Drop DONE rows written by older versions (processed rows are deleted now).
+    Rows left PROCESSING by a crash need no reset: their lease expires (see claim_pending_events).
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            count = cursor.execute("DELETE FROM `event_outbox` WHERE status = 'DONE'")
+        conn.commit()
+        return count
+    finally:
+        conn.close()
+
+def requeue_failed_events():
+    """Give FAILED outbox rows a fresh set of attempts. Returns the number requeued."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            count = cursor.execute(
+                "UPDATE `event_outbox` SET status = 'PENDING', attempts = 0, next_attempt_at = NULL "
+                "WHERE status = 'FAILED'"
+            )
+        conn.commit()
+        return count
+    finally:
+        conn.close()
+
+# --- Shared Access Token ---
+
+def get_shared_token(app_key):
+    """
+    Read the shared access token for an app.
+    Returns: (access_token, expires_at) or (None, 0) if not stored.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT access_token, expires_at FROM `dingtalk_token` WHERE app_key = %s", (app_key,))
+            row = cursor.fetchone()
+            if row and row['access_token']:
+                return row['access_token'], row['expires_at']
+    finally:
+        conn.close()
+    return None, 0
+
+def refresh_shared_token(app_key, fetch_fn, min_valid_until):
+    """
+    Refresh the shared token under a row lock, so only one process calls
+    DingTalk; the others wait and reuse the result.
+    fetch_fn: callable returning (access_token, expires_at).
+    Returns: (access_token, expires_at)
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT IGNORE INTO `dingtalk_token` (`app_key`) VALUES (%s)", (app_key,))
+            conn.commit()
+            cursor.execute("SELECT access_token, expires_at FROM `dingtalk_token` WHERE app_key = %s FOR UPDATE", (app_key,))
+            row = cursor.fetchone()
+            if row and row['access_token'] and row['expires_at'] > min_valid_until:
+                # Refreshed by another process while we waited for the lock
+                conn.commit()
+                return row['access_token'], row['expires_at']
+
+            token, expires_at = fetch_fn()
+            cursor.execute(
+                "UPDATE `dingtalk_token` SET access_token = %s, expires_at = %s WHERE app_key = %s",
+                (token, expires_at, app_key)
+            )
+        conn.commit()
+        return token, expires_at
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error refreshing shared token: {e}")
+        raise
+    finally:
+        conn.close()
+
+# --- Sync Retry / Dead Letter ---
+
+def record_sync_failure(process_instance_id, reason, base_delay=60, max_delay=21600):
+    """
+    Record a failed instance sync and schedule its retry.
+    The delay doubles with every failure: base_delay * 2^(attempts-1), capped at max_delay.
+    """
+    retry_sql = """
+    INSERT INTO `sync_retry` (`process_instance_id`, `reason`, `attempts`, `next_retry_at`)
+    VALUES (%(pid)s, %(reason)s, 1, NOW() + INTERVAL %(base)s SECOND)
+    AS new
+    ON DUPLICATE KEY UPDATE
+        `reason` = new.reason,
+        `next_retry_at` = NOW() + INTERVAL LEAST(%(base)s * POW(2, `attempts`), %(max)s) SECOND,
+        `attempts` = `attempts` + 1;
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(retry_sql, {
+                'pid': process_instance_id,
+                'reason': str(reason)[:512],
+                'base': base_delay,
+                'max': max_delay,
+            })
+        conn.commit()
+    finally:
+        conn.close()
+
+def clear_sync_failures(process_instance_ids):
+    """Forget failures of a batch of instances that synced successfully."""
+    ids = list(process_instance_ids)
+    if not ids:
+        return
+    placeholders = ",".join(["%s"] * len(ids))
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DELETE FROM `sync_retry` WHERE process_instance_id IN ({placeholders})", ids)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_due_retries(limit=100):
+    """
+    Return failures whose retry time has come, oldest first.
+    Returns: list of dicts {'process_instance_id', 'attempts', 'reason'}
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT process_instance_id, attempts, reason FROM `sync_retry` "
+                "WHERE next_retry_at <= NOW() ORDER BY next_retry_at LIMIT %s",
+                (limit,)
+            )
+            return list(cursor.fetchall())
+    finally:
+        conn.close()
+
+def move_to_dead_letter(process_instance_id):
+    """Park a failure that exhausted its retries in `sync_dead_letter`."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "REPLACE INTO `sync_dead_letter` (`process_instance_id`, `reason`, `attempts`, `first_failed_at`) "
+                "SELECT process_instance_id, reason, attempts, create_time FROM `sync_retry` WHERE process_instance_id = %s",
+                (process_instance_id,)
+            )
+            cursor.execute("DELETE FROM `sync_retry` WHERE process_instance_id = %s", (process_instance_id,))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error moving {process_instance_id} to dead letter: {e}")
+        raise
+    finally:
+        conn.close()
+
+def get_dead_letters(limit=100):
+    """Return parked failures, most recent first."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT process_instance_id, reason, attempts, first_failed_at, dead_time "
+                "FROM `sync_dead_letter` ORDER BY dead_time DESC LIMIT %s",
+                (limit,)
+            )
+            return list(cursor.fetchall())
+    finally:
+        conn.close()
+
+def delete_dead_letter(process_instance_id):
+    """Remove an entry from the dead letter table (after a successful replay)."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM `sync_dead_letter` WHERE process_instance_id = %s", (process_instance_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+# --- Partitioning / Archival ---
+
+PROCESS_INSTANCE_COLUMNS = (
+    "`process_instance_id`, `title`, `create_time`, `finish_time`, `originator_userid`, "
+    "`originator_dept_id`, `status`, `result`, `business_id`, `process_code`, `form_component_values`, "
+    "`originator_name`, `current_approvers`, `update_time`, `tasks`, `form_values_cleaned`"
+)
+
+def _month_start(d, offset=0):
+    """First day of the month `offset` months after the month of `d`."""
+    month_index = d.year * 12 + (d.month - 1) + offset
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def _get_partitions(cursor):
+    """Return names of the existing process_instance partitions (empty if not partitioned)."""
+    cursor.execute(
+        "SELECT PARTITION_NAME AS name FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'process_instance' AND PARTITION_NAME IS NOT NULL"
+    )
+    return [r['name'] for r in cursor.fetchall()]
+
+def _partition_defs(first_month, last_month):
+    """Monthly `pYYYYMM` partitions from first_month up to and including last_month."""
+    defs = []
+    month = first_month
+    while month <= last_month:
+        upper = _month_start(month, 1)
+        defs.append(f"PARTITION p{month.strftime('%Y%m')} VALUES LESS THAN ('{upper.isoformat()}')")
+        month = upper
+    return defs
+
+def manage_partitions(months_ahead=3):
+    """
+    Partition process_instance by month of `create_time` (RANGE COLUMNS) and keep
+    `months_ahead` empty future partitions. Safe to run repeatedly (e.g. monthly cron).
+    The first run rebuilds the table: the primary key becomes
+    (process_instance_id, create_time), as MySQL requires the partition column in every unique key.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            last_month = _month_start(date.today(), months_ahead)
+            partitions = _get_partitions(cursor)
+
+            if not partitions:
+                cursor.execute("SELECT COUNT(*) AS n FROM `process_instance` WHERE create_time IS NULL")
+                if cursor.fetchone()['n']:
+                    raise Exception("process_instance has rows without create_time; fix them before partitioning")
+
+                cursor.execute("SELECT MIN(create_time) AS min_time FROM `process_instance`")
+                min_time = cursor.fetchone()['min_time'] or datetime.now()
+                defs = _partition_defs(_month_start(min_time), last_month)
+
+                logger.info(f"Partitioning process_instance into {len(defs)} monthly partitions (this rebuilds the table)...")
+                cursor.execute(
+                    "ALTER TABLE `process_instance` "
+                    "MODIFY `create_time` DATETIME NOT NULL COMMENT 'Creation Time', "
+                    "DROP PRIMARY KEY, ADD PRIMARY KEY (`process_instance_id`, `create_time`)"
+                )
+                cursor.execute(
+                    "ALTER TABLE `process_instance` PARTITION BY RANGE COLUMNS(`create_time`) ("
+                    + ", ".join(defs + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]) + ")"
+                )
+                logger.info("process_instance partitioned.")
+                return
+
+            monthly = sorted(p for p in partitions if p != 'pmax')
+            if monthly:
+                newest = datetime.strptime(monthly[-1][1:], '%Y%m').date()
+                first_month = _month_start(newest, 1)
+            else:
+                # Only pmax left (e.g. monthly partitions dropped by hand): split it from the oldest row on
+                cursor.execute("SELECT MIN(create_time) AS min_time FROM `process_instance`")
+                first_month = _month_start(cursor.fetchone()['min_time'] or datetime.now())
+            defs = _partition_defs(first_month, last_month)
+            if defs:
+                # pmax is empty as long as it stays ahead of the data, so this is cheap
+                cursor.execute(
+                    "ALTER TABLE `process_instance` REORGANIZE PARTITION pmax INTO ("
+                    + ", ".join(defs + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]) + ")"
+                )
+                logger.info(f"Added {len(defs)} future partitions to process_instance.")
+            else:
+                logger.info("process_instance partitions are up to date.")
+    except Exception as e:
+        logger.error(f"Error managing partitions: {e}")
+        raise
+    finally:
+        conn.close()
+
+def archive_finished_instances(cutoff, batch_size=1000):
+    """
+    Move COMPLETED/TERMINATED instances created before `cutoff` (date or 'YYYY-MM-DD')
+    into the compressed `process_instance_archive` table, `batch_size` rows per transaction.
+    Returns: number of archived instances.
+    """
+    select_sql = (
+        "SELECT process_instance_id FROM `process_instance` "
+        "WHERE create_time < %s AND status IN ('COMPLETED', 'TERMINATED') "
+        "ORDER BY create_time LIMIT %s FOR UPDATE"
+    )
+
+    total = 0
+    conn = get_connection()
+    try:
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute(select_sql, (cutoff, batch_size))
+                ids = [r['process_instance_id'] for r in cursor.fetchall()]
+                if not ids:
+                    conn.commit()
+                    break
+
+                placeholders = ",".join(["%s"] * len(ids))
+                # The create_time bound lets a partitioned table prune to the partitions before the cutoff
+                cursor.execute(
+                    f"REPLACE INTO `process_instance_archive` ({PROCESS_INSTANCE_COLUMNS}) "
+                    f"SELECT {PROCESS_INSTANCE_COLUMNS} FROM `process_instance` "
+                    f"WHERE process_instance_id IN ({placeholders}) AND create_time < %s",
+                    ids + [cutoff]
+                )
+                cursor.execute(
+                    f"DELETE FROM `process_instance` WHERE process_instance_id IN ({placeholders}) AND create_time < %s",
+                    ids + [cutoff]
+                )
+            conn.commit()
+            total += len(ids)
+            logger.info(f"Archived {total} instances...")
+        return total
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error archiving instances: {e}")
+        raise
+    finally:
+        conn.close()
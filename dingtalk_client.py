@@ -2,18 +2,88 @@ import os
 import requests
 import time
 import logging
+import threading
+import contextvars
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+from tenants import bind
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# topapi/v2/user/get: "找不到该用户"
+USER_NOT_FOUND_ERRCODE = 60121
+
+# API call priorities (see RateLimiter): live events first, backfills use what is left
+PRIORITY_LIVE = 0
+PRIORITY_BACKFILL = 1
+
+_priority = contextvars.ContextVar('api_priority', default=PRIORITY_LIVE)
+
+@contextmanager
+def api_priority(priority):
+    """Run the enclosed API calls at `priority` (PRIORITY_LIVE by default)."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class RateLimiter:
+    """
+    Thread-safe token bucket. `acquire()` blocks until a call is allowed.
+    rate: calls per second, burst: max calls allowed back to back.
+    Strict priority: while a PRIORITY_LIVE caller is waiting, PRIORITY_BACKFILL
+    callers get no tokens, so backfills only use the capacity live work leaves.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.live_waiting = 0
+
+    def acquire(self, priority=None):
+        """priority: PRIORITY_LIVE/PRIORITY_BACKFILL, default from the api_priority() context."""
+        live = (_priority.get() if priority is None else priority) == PRIORITY_LIVE
+        with self.cond:
+            if live:
+                self.live_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1 and (live or not self.live_waiting):
+                        self.tokens -= 1
+                        return
+                    # Backfill callers held back by live waiters are woken when those leave
+                    self.cond.wait((1 - self.tokens) / self.rate if self.tokens < 1 else 1 / self.rate)
+            finally:
+                if live:
+                    self.live_waiting -= 1
+                    self.cond.notify_all()
+
 class DingTalkClient:
-    def __init__(self):
-        self.app_key = os.getenv('DINGTALK_CLIENT_ID', '').strip()
-        self.app_secret = os.getenv('DINGTALK_CLIENT_SECRET', '').strip()
+    def __init__(self, app_key=None, app_secret=None, rate_limiter=None):
+        self.app_key = (app_key or os.getenv('DINGTALK_CLIENT_ID', '')).strip()
+        self.app_secret = (app_secret or os.getenv('DINGTALK_CLIENT_SECRET', '')).strip()
+        # Optional RateLimiter shared by every API call of this client (per-app quota)
+        self.rate_limiter = rate_limiter
+        # Overridable for tests (e.g. the local stub used by loadtest.py)
+        self.base_url = os.getenv('DINGTALK_API_BASE', 'https://oapi.dingtalk.com').rstrip('/')
         self.access_token = None
         self.token_expires_at = 0
+        self._token_lock = threading.Lock()
+        self._refresher = None
+        # 'memory' (per process) or 'db' (shared by all processes using the same database)
+        self.token_store = os.getenv('DINGTALK_TOKEN_STORE', 'memory').strip().lower()
+        # Background renewal starts this many seconds before expiry
+        self.refresh_ahead = int(os.getenv('DINGTALK_TOKEN_REFRESH_AHEAD', 600))
         
         # Debug log (masked)
         if self.app_key:
@@ -22,16 +92,50 @@ class DingTalkClient:
             logger.error("AppKey is empty!")
 
 
+    def _throttle(self):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
     def get_access_token(self):
         """
         Get Access Token, refresh if expired.
+        Only one thread refreshes at a time; the others wait and reuse its token.
         """
         # RAM Cache Check
         if self.access_token and time.time() < self.token_expires_at:
             # logger.debug("Using cached AccessToken")
             return self.access_token
 
-        url = "https://oapi.dingtalk.com/gettoken"
+        with self._token_lock:
+            # Another thread may have refreshed while we were waiting
+            if self.access_token and time.time() < self.token_expires_at:
+                return self.access_token
+            self._refresh_access_token(time.time())
+            return self.access_token
+
+    def _refresh_access_token(self, min_valid_until):
+        """
+        Load a token valid past `min_valid_until`, from the shared store if
+        enabled (DINGTALK_TOKEN_STORE=db), otherwise straight from DingTalk.
+        Caller must hold `_token_lock`.
+        """
+        if self.token_store == 'db':
+            from db import get_shared_token, refresh_shared_token
+            token, expires_at = get_shared_token(self.app_key)
+            if not token or expires_at <= min_valid_until:
+                token, expires_at = refresh_shared_token(self.app_key, self._request_access_token, min_valid_until)
+        else:
+            token, expires_at = self._request_access_token()
+
+        self.access_token = token
+        self.token_expires_at = expires_at
+
+    def _request_access_token(self):
+        """
+        Call DingTalk gettoken.
+        Returns: (access_token, expires_at) where expires_at is an epoch timestamp.
+        """
+        url = f"{self.base_url}/gettoken"
         params = {
             "appkey": self.app_key,
             "appsecret": self.app_secret
@@ -40,11 +144,10 @@ class DingTalkClient:
             response = requests.get(url, params=params)
             data = response.json()
             if data.get("errcode") == 0:
-                self.access_token = data["access_token"]
                 # Expires in 7200s, refresh 5 mins early
-                self.token_expires_at = time.time() + data.get("expires_in", 7200) - 300
+                expires_at = time.time() + data.get("expires_in", 7200) - 300
                 logger.info("Successfully obtained AccessToken (refreshed)")
-                return self.access_token
+                return data["access_token"], expires_at
             else:
                 logger.error(f"Failed to get AccessToken: {data}")
                 raise Exception(f"DingTalk Token Error: {data}")
@@ -52,12 +155,38 @@ class DingTalkClient:
             logger.error(f"Error requesting AccessToken: {e}")
             raise
 
+    def start_token_refresher(self):
+        """
+        Renew the token in a background thread before it expires, so request
+        threads of long-running modes never block on a refresh.
+        Call with the client's tenant active: the DB token store is per tenant database.
+        """
+        if self._refresher:
+            return
+        self._refresher = threading.Thread(target=bind(self._token_refresher_loop), name="token-refresher", daemon=True)
+        self._refresher.start()
+
+    def _token_refresher_loop(self):
+        while True:
+            delay = self.token_expires_at - self.refresh_ahead - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            try:
+                with self._token_lock:
+                    self._refresh_access_token(time.time() + self.refresh_ahead)
+            except Exception as e:
+                logger.warning(f"Background token refresh failed: {e}")
+            # Avoid a busy loop if the new token is already inside the renewal window
+            if self.token_expires_at - self.refresh_ahead - time.time() <= 0:
+                time.sleep(30)
+
     def get_department_list_ids(self, parent_dept_id=None):
         """
         Recursively fetch all department IDs.
         If parent_dept_id is None, starts from root.
         """
-        url = "https://oapi.dingtalk.com/topapi/v2/department/listsub"
+        url = f"{self.base_url}/topapi/v2/department/listsub"
         token = self.get_access_token()
         params = {"access_token": token}
         payload = {}
@@ -67,6 +196,7 @@ class DingTalkClient:
         all_dept_ids = []
         
         try:
+            self._throttle()
             response = requests.post(url, params=params, json=payload)
             data = response.json()
             if data.get("errcode") == 0:
@@ -90,7 +220,7 @@ class DingTalkClient:
         Fetch all users in a department.
         Returns a list of dicts: [{'userid': '...', 'name': '...'}]
         """
-        url = "https://oapi.dingtalk.com/topapi/v2/user/list"
+        url = f"{self.base_url}/topapi/v2/user/list"
         token = self.get_access_token()
         params = {"access_token": token}
         payload = {
@@ -102,6 +232,7 @@ class DingTalkClient:
         all_users = []
         while True:
             try:
+                self._throttle()
                 response = requests.post(url, params=params, json=payload)
                 data = response.json()
                 if data.get("errcode") == 0:
@@ -121,11 +252,38 @@ class DingTalkClient:
                 raise
         return all_users
 
+    def get_user_detail(self, userid):
+        """
+        Fetch a single user's details.
+        Returns a dict {'userid': '...', 'name': '...'}, or None if the user doesn't exist.
+        """
+        url = f"{self.base_url}/topapi/v2/user/get"
+        token = self.get_access_token()
+        params = {"access_token": token}
+        payload = {"userid": userid, "language": "zh_CN"}
+
+        try:
+            self._throttle()
+            response = requests.post(url, params=params, json=payload)
+            data = response.json()
+        except Exception as e:
+            logger.error(f"Error getting user {userid}: {e}")
+            raise
+
+        if data.get("errcode") == 0:
+            u = data.get("result", {})
+            return {'userid': u.get('userid', userid), 'name': u.get('name')}
+        elif data.get("errcode") == USER_NOT_FOUND_ERRCODE:
+            return None
+        else:
+            logger.error(f"Failed to get user {userid}: {data}")
+            raise Exception(f"DingTalk API Error: {data}")
+
     def get_user_visible_process_codes(self, userid):
         """
         Fetch list of process codes visible to a specific user.
         """
-        url = "https://oapi.dingtalk.com/topapi/process/listbyuserid"
+        url = f"{self.base_url}/topapi/process/listbyuserid"
         token = self.get_access_token()
         params = {"access_token": token}
         
@@ -136,6 +294,7 @@ class DingTalkClient:
         }
         
         try:
+            self._throttle()
             response = requests.post(url, params=params, json=payload)
             data = response.json()
             if data.get("errcode") == 0:
@@ -155,10 +314,19 @@ class DingTalkClient:
         start_time_str, end_time_str: 'yyyy-MM-dd HH:mm:ss' (or compatible format)
         Returns: list of instance IDs.
         """
+        all_ids = []
+        for id_list in self.iter_process_instance_id_pages(start_time_str, end_time_str, process_code):
+            all_ids.extend(id_list)
+        return all_ids
+
+    def iter_process_instance_id_pages(self, start_time_str, end_time_str, process_code, limiter=None):
+        """
+        Generator over process instance IDs, one page (list of IDs) at a time,
+        so callers can start syncing before the whole range has been listed.
+        limiter: optional RateLimiter acquired before every page request.
+        """
         # Corrected URL: processinstance/listids (no slash between process and instance)
-        url = "https://oapi.dingtalk.com/topapi/processinstance/listids"
-        token = self.get_access_token()
-        params = {"access_token": token}
+        url = f"{self.base_url}/topapi/processinstance/listids"
         
         # Convert to milliseconds timestamp
         def to_ts(time_str):
@@ -168,7 +336,6 @@ class DingTalkClient:
         start_time = to_ts(start_time_str)
         end_time = to_ts(end_time_str)
         
-        all_ids = []
         cursor = 0
         size = 20
         
@@ -180,33 +347,38 @@ class DingTalkClient:
                 "size": size,
                 "cursor": cursor
             }
+            if limiter:
+                limiter.acquire()
+            # Token looked up per page: long listings can outlive a token
+            params = {"access_token": self.get_access_token()}
             
             try:
+                self._throttle()
                 response = requests.post(url, params=params, json=payload)
                 data = response.json()
-                if data.get("errcode") == 0:
-                    result = data.get("result", {})
-                    id_list = result.get("list", [])
-                    all_ids.extend(id_list)
-                    
-                    if not result.get("next_cursor"):
-                        break
-                    cursor = result.get("next_cursor")
-                else:
-                    logger.error(f"Failed to get process instance IDs: {data}")
-                    raise Exception(f"DingTalk API Error: {data}")
             except Exception as e:
                 logger.error(f"Error getting process instance IDs: {e}")
                 raise
+
+            if data.get("errcode") == 0:
+                result = data.get("result", {})
+                id_list = result.get("list", [])
+                if id_list:
+                    yield id_list
                 
-        return all_ids
+                if not result.get("next_cursor"):
+                    break
+                cursor = result.get("next_cursor")
+            else:
+                logger.error(f"Failed to get process instance IDs: {data}")
+                raise Exception(f"DingTalk API Error: {data}")
 
     def get_process_instance_detail(self, process_instance_id):
         """
         Fetch details for a single process instance.
         """
         # Corrected URL: processinstance/get
-        url = "https://oapi.dingtalk.com/topapi/processinstance/get"
+        url = f"{self.base_url}/topapi/processinstance/get"
         token = self.get_access_token()
         params = {"access_token": token}
         
@@ -215,6 +387,7 @@ class DingTalkClient:
         }
         
         try:
+            self._throttle()
             response = requests.post(url, params=params, json=payload)
             data = response.json()
             if data.get("errcode") == 0:
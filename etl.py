@@ -1,9 +1,8 @@
 import json
 import logging
 from db import get_connection, create_table_if_not_exists
+from log_config import setup_logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 def parse_component_list(components):
@@ -109,6 +108,8 @@ def process_single_record(record):
         return None
 
 def main():
+    setup_logging()
+
     # Ensure schema is up to date
     create_table_if_not_exists()
     
@@ -0,0 +1,261 @@
+import os
+import re
+import csv
+import json
+import logging
+from datetime import datetime
+
+import pymysql
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = '_export_state.json'
+# Column types per dataset and process code, kept across incremental runs
+SCHEMA_FILE = '_export_schema.json'
+
+# Columns exported as-is from process_instance
+BASE_COLUMNS = [
+    'process_instance_id', 'title', 'create_time', 'finish_time',
+    'originator_userid', 'originator_name', 'originator_dept_id',
+    'status', 'result', 'business_id', 'process_code',
+    'current_approvers', 'update_time'
+]
+
+# Non-form columns that aren't strings; form.* columns are typed from their values (see _type_rows)
+FIXED_TYPES = {'create_time': 'timestamp', 'finish_time': 'timestamp', 'update_time': 'timestamp', 'row_index': 'int'}
+
+# Form column types, narrowest first. A column's type only ever moves right.
+TYPE_ORDER = ['int', 'float', 'string']
+
+def load_watermark(out_dir):
+    """Return the `update_time` up to which the previous export ran, or None."""
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('watermark')
+
+def save_watermark(out_dir, watermark):
+    path = os.path.join(out_dir, STATE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'watermark': watermark}, f)
+    os.replace(tmp_path, path)
+
+def load_schema(out_dir):
+    """Return {dataset: {process_code: {column: type}}} recorded by previous exports."""
+    path = os.path.join(out_dir, SCHEMA_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_schema(out_dir, schema):
+    path = os.path.join(out_dir, SCHEMA_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(schema, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def flatten_instance(row):
+    """
+    Split one process_instance row into a flat record and its detail rows.
+    Scalar form fields become `form.<label>` columns; every TableField (list of rows)
+    is exploded into the child dataset, one record per row.
+    Returns: (record, detail_rows)
+    """
+    record = {c: row.get(c) for c in BASE_COLUMNS}
+    details = []
+
+    cleaned = row.get('form_values_cleaned')
+    if isinstance(cleaned, str):
+        try:
+            cleaned = json.loads(cleaned)
+        except Exception:
+            cleaned = None
+
+    for label, value in (cleaned or {}).items():
+        # An empty list isn't recognisable as a TableField; it stays on the record as "[]"
+        if isinstance(value, list) and value and all(isinstance(r, dict) for r in value):
+            for i, table_row in enumerate(value):
+                detail = {
+                    'process_instance_id': row['process_instance_id'],
+                    'process_code': row.get('process_code'),
+                    'table_name': label,
+                    'row_index': i,
+                }
+                for k, v in table_row.items():
+                    detail[f"form.{k}"] = v
+                details.append(detail)
+        else:
+            record[f"form.{label}"] = value
+
+    return record, details
+
+def _coerce(value):
+    """Convert a form value to int/float when it looks numeric, keep everything else."""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, str):
+        v = value.strip()
+        # No leading zeros: codes like "007" must stay strings
+        if re.fullmatch(r'-?(0|[1-9]\d{0,17})', v):
+            return int(v)
+        if re.fullmatch(r'-?(0|[1-9]\d*)\.\d+', v):
+            return float(v)
+    return value
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return 'string'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'string'
+
+def _type_rows(rows, columns, known):
+    """
+    Give every `form.*` column one type for the whole dataset: the type recorded in
+    `known` by earlier runs, widened (int -> float -> string) if this batch needs it.
+    Columns with no value yet default to string. `known` is updated in place.
+    """
+    for col in columns:
+        if not col.startswith('form.'):
+            continue
+        coerced = [_coerce(r.get(col)) for r in rows]
+        seen = {_value_type(v) for v in coerced if v not in (None, '')}
+        if known.get(col):
+            seen.add(known[col])
+        col_type = max(seen, key=TYPE_ORDER.index) if seen else 'string'
+        known[col] = col_type
+
+        for r, v in zip(rows, coerced):
+            if v in (None, ''):
+                r[col] = None
+            elif col_type == 'int':
+                r[col] = v
+            elif col_type == 'float':
+                r[col] = float(v)
+            else:
+                # Original text, not the coerced number: keeps "007" and "1.50" as written
+                original = r.get(col)
+                r[col] = original if isinstance(original, str) else json.dumps(original, ensure_ascii=False)
+    return rows
+
+def _arrow_schema(columns, types):
+    import pyarrow as pa
+    arrow_types = {'int': pa.int64(), 'float': pa.float64(), 'string': pa.string(), 'timestamp': pa.timestamp('s')}
+    return pa.schema([
+        (c, arrow_types[types.get(c) or FIXED_TYPES.get(c, 'string')]) for c in columns
+    ])
+
+def _partition_dir(out_dir, dataset, process_code, month):
+    safe_code = re.sub(r'[^\w\-]', '_', process_code or 'unknown')
+    return os.path.join(out_dir, dataset, f"process_code={safe_code}", f"create_month={month}")
+
+def _write_partition(out_dir, dataset, process_code, month, rows, fmt, run_id, schema):
+    """
+    Write one partition file. Columns are the union of keys, base columns first.
+    schema: column types of this dataset/process code (see _type_rows), updated in place.
+    """
+    if not rows:
+        return
+    columns = []
+    for r in rows:
+        for k in r:
+            if k not in columns:
+                columns.append(k)
+    types = schema.setdefault(dataset, {}).setdefault(process_code or 'unknown', {})
+    _type_rows(rows, columns, types)
+
+    path = _partition_dir(out_dir, dataset, process_code, month)
+    os.makedirs(path, exist_ok=True)
+    file_path = os.path.join(path, f"part-{run_id}.{fmt}")
+
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(rows, schema=_arrow_schema(columns, types))
+        pq.write_table(table, file_path, compression='snappy')
+    else:
+        with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def export_instances(out_dir, fmt='csv', full=False):
+    """
+    Stream `process_instance` into partitioned files under out_dir:
+        instances/process_code=<code>/create_month=<YYYY-MM>/part-<run>.<fmt>
+        details/process_code=<code>/create_month=<YYYY-MM>/part-<run>.<fmt>   (TableField rows)
+    Incremental by default: only rows whose `update_time` changed since the last run are
+    written, so an instance can appear in several part files (keep the latest update_time).
+    """
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if fmt == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+
+    os.makedirs(out_dir, exist_ok=True)
+    since = None if full else load_watermark(out_dir)
+    schema = load_schema(out_dir)
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT NOW() AS now")
+            upper = cursor.fetchone()['now'].strftime('%Y-%m-%d %H:%M:%S')
+
+        logger.info(f"Exporting instances updated after {since or 'the beginning'} up to {upper} ({fmt})...")
+
+        # Half-open window [since, upper): rows touched later in the `upper` second go to the next run
+        where = "update_time < %s"
+        params = [upper]
+        if since:
+            where = "update_time >= %s AND " + where
+            params.insert(0, since)
+
+        sql = (
+            f"SELECT {', '.join(BASE_COLUMNS)}, form_values_cleaned FROM `process_instance` "
+            f"WHERE {where} ORDER BY process_code, create_time"
+        )
+
+        exported = 0
+        current_key = None
+        records, details = [], []
+        # Server-side cursor: rows are streamed, only one partition is held in memory
+        with conn.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute(sql, params)
+            for row in cursor:
+                month = row['create_time'].strftime('%Y-%m') if row.get('create_time') else 'unknown'
+                key = (row.get('process_code'), month)
+                if key != current_key:
+                    if current_key:
+                        _write_partition(out_dir, 'instances', *current_key, records, fmt, run_id, schema)
+                        _write_partition(out_dir, 'details', *current_key, details, fmt, run_id, schema)
+                    current_key, records, details = key, [], []
+
+                record, detail_rows = flatten_instance(row)
+                records.append(record)
+                details.extend(detail_rows)
+                exported += 1
+                if exported % 1000 == 0:
+                    logger.info(f"Exported {exported} instances...")
+
+            if current_key:
+                _write_partition(out_dir, 'instances', *current_key, records, fmt, run_id, schema)
+                _write_partition(out_dir, 'details', *current_key, details, fmt, run_id, schema)
+
+        save_schema(out_dir, schema)
+        save_watermark(out_dir, upper)
+        logger.info(f"Export Completed. {exported} instances written to {out_dir}")
+        return exported
+    finally:
+        conn.close()
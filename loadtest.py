@@ -0,0 +1,348 @@
+"""
+Load generator / soak test for stream mode.
+
+Feeds synthetic bpms_instance_change / bpms_task_change events into
+AllEventHandler (outbox + OutboxWorker + real DB writes), while the DingTalk
+API is served by a local stub with injectable latency. Reports ack latency
+percentiles, end-to-end sync lag, DB write rate and memory every interval.
+
+Point DB_NAME at a scratch database: the test writes synthetic instances.
+
+Usage:
+  python loadtest.py --rate 50 --duration 300
+  python loadtest.py --shape burst --rate 20 --burst-rate 500 --burst-seconds 5 --period 60
+  python loadtest.py --shape ramp --rate 200 --duration 600 --api-latency-ms 150
+  python loadtest.py --rate 30 --duration 86400 --report-interval 300   # soak
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+import tracemalloc
+import zlib
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+logger = logging.getLogger('loadtest')
+
+# --- Stub DingTalk API ---
+
+class StubDingTalkHandler(BaseHTTPRequestHandler):
+    """Serves the endpoints used by a stream sync: gettoken, processinstance/get, v2/user/get."""
+    latency_ms = 0
+    jitter_ms = 0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def _send(self, body):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/gettoken':
+            self._send({'errcode': 0, 'access_token': 'stub-token', 'expires_in': 7200})
+        else:
+            self._send({'errcode': 404, 'errmsg': 'not stubbed'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        path = urlparse(self.path).path
+        self._delay()
+
+        if random.random() < self.error_rate:
+            self._send({'errcode': 90018, 'errmsg': 'stub injected error'})
+        elif path == '/topapi/processinstance/get':
+            self._send({'errcode': 0, 'process_instance': stub_instance(body.get('process_instance_id'))})
+        elif path == '/topapi/v2/user/get':
+            uid = body.get('userid')
+            self._send({'errcode': 0, 'result': {'userid': uid, 'name': f"User {uid}"}})
+        else:
+            self._send({'errcode': 404, 'errmsg': 'not stubbed'})
+
+def stub_instance(pid):
+    """A RUNNING instance with a few form fields, a detail table and running tasks."""
+    seed = zlib.crc32(str(pid).encode())
+    user = f"u{seed % 500}"
+    table = [{'rowValue': [{'label': '项目', 'value': f"item {i}"}, {'label': '金额', 'value': str(i * 10)}]}
+             for i in range(3)]
+    return {
+        'title': f"Load test {pid}",
+        'create_time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'finish_time': None,
+        'originator_userid': user,
+        'originator_dept_id': '1',
+        'status': 'RUNNING',
+        'result': '',
+        'business_id': pid,
+        'process_code': 'PROC-LOADTEST',
+        'form_component_values': [
+            {'component_type': 'TextField', 'name': '事由', 'value': 'x' * 200},
+            {'component_type': 'MoneyField', 'name': '金额', 'value': '1234.5'},
+            {'component_type': 'TableField', 'name': '明细', 'value': json.dumps(table, ensure_ascii=False)},
+        ],
+        'tasks': [{'userid': f"u{(seed + i) % 500}", 'task_status': 'RUNNING'} for i in range(2)],
+    }
+
+def start_stub_server(latency_ms, jitter_ms, error_rate):
+    StubDingTalkHandler.latency_ms = latency_ms
+    StubDingTalkHandler.jitter_ms = jitter_ms
+    StubDingTalkHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubDingTalkHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-api', daemon=True).start()
+    return server
+
+# --- Metrics ---
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+class Metrics:
+    """Per-interval samples plus bounded reservoirs for the final summary (memory stays flat)."""
+    RESERVOIR_SIZE = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # pid -> emit time of the oldest event not yet written
+        self.started = time.monotonic()
+        self.reset_window()
+        self.totals = {'events': 0, 'acks_failed': 0, 'writes': 0}
+        self.ack_reservoir, self.lag_reservoir = [], []
+        self.seen = {'ack': 0, 'lag': 0}
+
+    def reset_window(self):
+        self.window_start = time.monotonic()
+        self.ack_ms, self.lag_ms = [], []
+        self.window_events = self.window_writes = 0
+
+    def _reservoir(self, name, reservoir, value):
+        self.seen[name] += 1
+        if len(reservoir) < self.RESERVOIR_SIZE:
+            reservoir.append(value)
+        else:
+            i = random.randrange(self.seen[name])
+            if i < self.RESERVOIR_SIZE:
+                reservoir[i] = value
+
+    def event_emitted(self, pid, emitted_at):
+        with self.lock:
+            self.pending.setdefault(pid, emitted_at)
+
+    def event_acked(self, ack_ms, ok):
+        with self.lock:
+            self.ack_ms.append(ack_ms)
+            self._reservoir('ack', self.ack_reservoir, ack_ms)
+            self.window_events += 1
+            self.totals['events'] += 1
+            if not ok:
+                self.totals['acks_failed'] += 1
+
+    def instance_written(self, pid):
+        now = time.monotonic()
+        with self.lock:
+            self.window_writes += 1
+            self.totals['writes'] += 1
+            emitted_at = self.pending.pop(pid, None)
+            if emitted_at is not None:
+                lag = (now - emitted_at) * 1000
+                self.lag_ms.append(lag)
+                self._reservoir('lag', self.lag_reservoir, lag)
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.window_start, 1e-9)
+            ack, lag = sorted(self.ack_ms), sorted(self.lag_ms)
+            events, writes, backlog = self.window_events, self.window_writes, len(self.pending)
+            self.reset_window()
+        current, peak = tracemalloc.get_traced_memory()
+        logger.info(
+            f"[{time.monotonic() - self.started:7.0f}s] events {events / elapsed:7.1f}/s | "
+            f"ack ms p50 {percentile(ack, 50):6.1f} p95 {percentile(ack, 95):6.1f} p99 {percentile(ack, 99):6.1f} | "
+            f"lag ms p50 {percentile(lag, 50):7.0f} p95 {percentile(lag, 95):7.0f} p99 {percentile(lag, 99):7.0f} | "
+            f"writes {writes / elapsed:6.1f}/s | unsynced {backlog} | "
+            f"mem {current / 1048576:6.1f} MiB (peak {peak / 1048576:6.1f})"
+        )
+
+    def summary(self):
+        ack, lag = sorted(self.ack_reservoir), sorted(self.lag_reservoir)
+        elapsed = time.monotonic() - self.started
+        print("\n=== Load Test Summary ===")
+        print(f"Duration:        {elapsed:.0f}s")
+        print(f"Events:          {self.totals['events']} ({self.totals['events'] / elapsed:.1f}/s), "
+              f"failed acks: {self.totals['acks_failed']}")
+        print(f"DB writes:       {self.totals['writes']} ({self.totals['writes'] / elapsed:.1f}/s)")
+        print(f"Ack latency ms:  p50 {percentile(ack, 50):.1f}  p95 {percentile(ack, 95):.1f}  "
+              f"p99 {percentile(ack, 99):.1f}  max {ack[-1] if ack else 0:.1f}")
+        print(f"Sync lag ms:     p50 {percentile(lag, 50):.0f}  p95 {percentile(lag, 95):.0f}  "
+              f"p99 {percentile(lag, 99):.0f}  max {lag[-1] if lag else 0:.0f}")
+        print(f"Still unsynced:  {len(self.pending)}")
+        print("=========================\n")
+
+# --- Event generation ---
+
+def current_rate(args, t):
+    """Target events/second at `t` seconds into the run for the chosen shape."""
+    if args.shape == 'ramp':
+        return args.rate * min(1.0, t / max(args.duration, 1))
+    if args.shape == 'burst':
+        return args.burst_rate if (t % args.period) < args.burst_seconds else args.rate
+    return args.rate
+
+def next_delay(args, t):
+    if args.shape == 'ramp':
+        return ramp_delay(args.rate, max(args.duration, 1), t)
+    rate = current_rate(args, t)
+    if args.shape == 'poisson':
+        return random.expovariate(rate)
+    return 1.0 / rate
+
+def ramp_delay(rate, duration, t):
+    """
+    Time until the next event on a linear ramp to `rate` over `duration` seconds:
+    the delay after which the ramp's integral has added one event. Using the rate
+    at `t` instead would stall at the start, where it is close to zero.
+    """
+    if t < duration:
+        # Events by time x on the ramp: rate * x^2 / (2 * duration)
+        t_next = math.sqrt(t * t + 2 * duration / rate)
+        if t_next <= duration:
+            return t_next - t
+        # The ramp ends before the next event; the rest comes at the full rate
+        left = 1 - rate * (duration * duration - t * t) / (2 * duration)
+        return duration - t + left / rate
+    return 1.0 / rate
+
+def make_event(pid):
+    event_type = random.choice(['bpms_instance_change', 'bpms_task_change'])
+    data = {'processInstanceId': pid, 'type': 'start', 'processCode': 'PROC-LOADTEST'}
+    return SimpleNamespace(
+        headers={'eventType': event_type, 'topic': '*', 'eventId': f"{pid}-{time.time_ns()}"},
+        data=json.dumps(data)
+    )
+
+async def run_load(args, handler, metrics):
+    from dingtalk_stream import AckMessage
+
+    async def fire(event, pid):
+        start = time.monotonic()
+        metrics.event_emitted(pid, start)
+        try:
+            code, _ = await handler.process(event)
+            ok = code == AckMessage.STATUS_OK
+        except Exception as e:
+            logger.error(f"Handler raised: {e}")
+            ok = False
+        metrics.event_acked((time.monotonic() - start) * 1000, ok)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            metrics.report()
+
+    report_task = asyncio.create_task(reporter())
+    tasks = set()
+    start = time.monotonic()
+    next_at = start
+    while True:
+        now = time.monotonic()
+        t = now - start
+        if t >= args.duration:
+            break
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        pid = f"LOADTEST-{random.randrange(args.instances)}"
+        # Like the SDK, every message is processed in its own task
+        task = asyncio.create_task(fire(make_event(pid), pid))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        next_at += next_delay(args, t)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    report_task.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator / soak test for stream mode")
+    parser.add_argument('--rate', type=float, default=20, help="events/second (peak rate for ramp)")
+    parser.add_argument('--shape', choices=['constant', 'poisson', 'burst', 'ramp'], default='constant')
+    parser.add_argument('--burst-rate', type=float, default=200, help="events/second during bursts")
+    parser.add_argument('--burst-seconds', type=float, default=5, help="burst length")
+    parser.add_argument('--period', type=float, default=60, help="seconds between burst starts")
+    parser.add_argument('--duration', type=float, default=60, help="seconds to generate events")
+    parser.add_argument('--drain-timeout', type=float, default=60, help="seconds to wait for the outbox afterwards")
+    parser.add_argument('--instances', type=int, default=1000, help="distinct instance IDs (repeats exercise dedup)")
+    parser.add_argument('--api-latency-ms', type=float, default=80, help="stub API mean latency")
+    parser.add_argument('--api-jitter-ms', type=float, default=40, help="stub API latency jitter (+/-)")
+    parser.add_argument('--api-error-rate', type=float, default=0.0, help="fraction of stub calls that fail")
+    parser.add_argument('--report-interval', type=float, default=10)
+    args = parser.parse_args()
+
+    from log_config import setup_logging
+    setup_logging()
+    # Keep per-event logs of the code under test out of the report
+    for name in ('main', 'stream_handler', 'db', 'dingtalk_client', 'user_resolver', 'outbox'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    server = start_stub_server(args.api_latency_ms, args.api_jitter_ms, args.api_error_rate)
+    os.environ['DINGTALK_API_BASE'] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault('DINGTALK_CLIENT_ID', 'loadtest')
+    os.environ.setdefault('DINGTALK_CLIENT_SECRET', 'loadtest')
+    logger.info(f"Stub DingTalk API on {os.environ['DINGTALK_API_BASE']}")
+
+    tracemalloc.start()
+    import main as app
+    from outbox import OutboxWorker
+    from stream_handler import AllEventHandler
+
+    app.create_table_if_not_exists()
+    metrics = Metrics()
+
+    # Observe DB writes made by the sync path
+    original_upsert = app.upsert_process_instance
+    def observed_upsert(record):
+        pid = record.get('process_instance_id')
+        original_upsert(record)
+        metrics.instance_written(pid)
+    app.upsert_process_instance = observed_upsert
+
+    outbox = OutboxWorker(app.sync_stream_instance, on_exhausted=app.record_failure)
+    outbox.start()
+    handler = AllEventHandler(outbox)
+
+    logger.info(f"Generating {args.shape} load at {args.rate}/s for {args.duration:.0f}s...")
+    try:
+        asyncio.run(run_load(args, handler, metrics))
+    except KeyboardInterrupt:
+        logger.info("Interrupted, draining...")
+
+    deadline = time.monotonic() + args.drain_timeout
+    while metrics.pending and time.monotonic() < deadline:
+        time.sleep(1)
+    metrics.report()
+    metrics.summary()
+    return 0 if not metrics.totals['acks_failed'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
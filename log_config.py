@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+from tenants import TenantLogFilter
+
+# Attributes every LogRecord has; anything else was passed via `extra=` and goes into JSON output
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, thread, message plus any `extra` fields."""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records as they are. The stdlib prepare() formats the message and
+    drops exc_info so records can be pickled; an in-process queue needs neither,
+    and the listener's formatter (e.g. JsonFormatter) still sees the exception.
+    """
+    def prepare(self, record):
+        return record
+
+def setup_logging(level=None, fmt=None):
+    """
+    Configure logging for the whole process (call once from an entry point).
+    Callers only enqueue records; a QueueListener thread formats and writes them,
+    so log I/O never blocks sync or stream threads.
+    LOG_LEVEL: DEBUG/INFO/... (default INFO), LOG_FORMAT: text (default) or json.
+    """
+    global _listener
+    if _listener:
+        return
+
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    fmt = (fmt or os.getenv('LOG_FORMAT', 'text')).lower()
+
+    # Tag lines with the tenant when several organizations share one process
+    text_format = TEXT_FORMAT.replace('%(message)s', '[%(tenant)s] %(message)s') if os.getenv('TENANTS_FILE') else TEXT_FORMAT
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(text_format))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    queue_handler = _LocalQueueHandler(log_queue)
+    # Filters run in the calling thread, where the tenant context is still available
+    queue_handler.addFilter(TenantLogFilter())
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    # Flush whatever is still queued on exit
+    atexit.register(_listener.stop)
+
+class LogSampler:
+    """
+    Rate limit for noisy log lines: `allow()` is True at most `max_per_interval`
+    times per `interval` seconds. Used for per-event payload dumps.
+    """
+    def __init__(self, max_per_interval, interval=60):
+        self.max_per_interval = max_per_interval
+        self.interval = interval
+        self.window_start = time.monotonic()
+        self.count = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Returns (allowed, suppressed_since_last_allowed)."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.interval:
+                self.window_start = now
+                self.count = 0
+            if self.count < self.max_per_interval:
+                self.count += 1
+                suppressed, self.suppressed = self.suppressed, 0
+                return True, suppressed
+            self.suppressed += 1
+            return False, 0
@@ -1,11 +1,11 @@
 import sys
-import asyncio
 import logging
 import os
-import json
 import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 
 # Local modules
@@ -13,28 +13,44 @@ from db import (
     create_table_if_not_exists, 
     upsert_process_instance, 
     upsert_dingtalk_users, 
-    get_user_name_from_db,
-    get_instance_status
+    get_user_names_from_db,
+    get_instance_status,
+    get_instance_statuses,
+    upsert_process_instances,
+    get_inflight_instance_ids,
+    record_sync_failure,
+    clear_sync_failures,
+    get_due_retries,
+    move_to_dead_letter,
+    get_dead_letters,
+    delete_dead_letter,
+    manage_partitions,
+    archive_finished_instances,
+    requeue_failed_events
 )
-from dingtalk_client import DingTalkClient
+from outbox import OutboxWorker
+from log_config import setup_logging
+from tenants import select_tenants, current_tenant, use_tenant, bind
 
-# DingTalk Stream SDK
-from dingtalk_stream import DingTalkStreamClient, Credential, EventHandler, AckMessage
+# NOTE: requests (via dingtalk_client), dateutil and the DingTalk Stream SDK are
+# imported inside the functions that need them to keep CLI startup fast.
 
 # ETL
 from etl import parse_component_list
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Logging is configured by setup_logging() in main()
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-# Global Client
-dt_client = DingTalkClient()
+def get_dt_client():
+    """Return the active tenant's DingTalkClient (created on first use)."""
+    return current_tenant().client
 
 def get_last_month_range():
     """Get the start and end date of the previous month."""
+    from dateutil.relativedelta import relativedelta
+
     today = date.today()
     last_month = today - relativedelta(months=1)
     start_date = last_month.replace(day=1)
@@ -42,15 +58,34 @@ def get_last_month_range():
     end_date = next_month.replace(day=1) - timedelta(days=1)
     return start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
 
-def get_user_name_cached(userid):
+def get_user_resolver():
+    """Return the active tenant's UserResolver (DB cache, DingTalk lookup on miss)."""
+    return current_tenant().resolver
+
+def resolve_user_names(userids):
     """
-    Get user name, try cache first. 
-    Note: For now we only read DB. Real-time fetch could be added if needed.
+    Get user names for a collection of IDs, try cache first.
+    Missing users are looked up in DingTalk unless USER_LOOKUP_ON_MISS=false.
+    Returns: dict {userid: name}, falling back to the ID if the name is not found.
     """
+    userids = {u for u in userids if u}
+    if not userids:
+        return {}
+    if os.getenv('USER_LOOKUP_ON_MISS', 'true').lower() == 'false':
+        try:
+            names = get_user_names_from_db(userids)
+        except Exception as e:
+            logger.error(f"Error fetching user names: {e}")
+            names = {}
+    else:
+        names = get_user_resolver().resolve(userids)
+    return {u: names.get(u) or u for u in userids} # Fallback to ID if name not found
+
+def get_user_name_cached(userid):
+    """Get a single user name, see resolve_user_names."""
     if not userid:
         return None
-    name = get_user_name_from_db(userid)
-    return name if name else userid # Fallback to ID if name not found
+    return resolve_user_names([userid])[userid]
 
 def transform_process_instance(instance_data, forced_id=None):
     """
@@ -75,7 +110,6 @@ def transform_process_instance(instance_data, forced_id=None):
     pid = get_val(['process_instance_id', 'processInstanceId']) or forced_id
     
     originator_userid = get_val(['originator_userid', 'originatorUserId'])
-    originator_name = get_user_name_cached(originator_userid)
     
     # Extract current approvers
     # Tasks structure: "tasks": [ { "userid": "...", "status": "RUNNING" } ]
@@ -100,10 +134,10 @@ def transform_process_instance(instance_data, forced_id=None):
     # if not current_approver_ids and has_running:
     #    logger.warning(f"Running tasks found but no approvers extracted. Tasks Dump: {json.dumps(tasks, ensure_ascii=False)}")
     
-    current_approver_names = []
-    for uid in current_approver_ids:
-        name = get_user_name_cached(uid)
-        current_approver_names.append(name)
+    # Resolve originator and approvers in one lookup
+    user_names = resolve_user_names(current_approver_ids | {originator_userid})
+    originator_name = user_names.get(originator_userid)
+    current_approver_names = [user_names[uid] for uid in current_approver_ids]
 
     current_approvers_str = ",".join(current_approver_names) if current_approver_names else None
 
@@ -131,35 +165,88 @@ def transform_process_instance(instance_data, forced_id=None):
         'form_values_cleaned': form_values_cleaned
     }
 
-def sync_single_instance(process_instance_id):
-    """Fetch and sync a single instance."""
+def fetch_instance_record(process_instance_id):
+    """
+    Fetch an instance from DingTalk and transform it to a DB record.
+    Returns None if the detail could not be fetched.
+    """
+    detail = get_dt_client().get_process_instance_detail(process_instance_id)
+    if not detail:
+        return None
+    # Pass the known ID to ensure it exists in the record
+    return transform_process_instance(detail, forced_id=process_instance_id)
+
+def sync_single_instance(process_instance_id, record_failures=True, clear_retry=False):
+    """
+    Fetch and sync a single instance.
+    Returns True if the instance is up to date (synced or skipped), False on failure.
+    Failures are scheduled in `sync_retry` unless record_failures is False
+    (the outbox retries stream events itself and hands over once it gives up).
+    clear_retry: the caller knows the instance has a `sync_retry` row; drop it on success.
+    Other callers leave a stray row to the retry job, which clears it on its next pass.
+    """
     try:
         # Idempotency Check
         # If instance exists and is already in a final state, skip sync.
         # Final states: COMPLETED, TERMINATED
         existing_status = get_instance_status(process_instance_id)
         if existing_status in ['COMPLETED', 'TERMINATED']:
-            logger.info(f"Skipping {process_instance_id} (Already {existing_status})")
-            return
+            logger.debug("Skipping %s (Already %s)", process_instance_id, existing_status)
+            if clear_retry:
+                forget_failures([process_instance_id])
+            return True
 
-        detail = dt_client.get_process_instance_detail(process_instance_id)
-        if not detail:
+        record = fetch_instance_record(process_instance_id)
+        if not record:
             logger.warning(f"Could not fetch details for {process_instance_id}")
-            return
+            if record_failures:
+                record_failure(process_instance_id, "Could not fetch details")
+            return False
         
-        # Pass the known ID to ensure it exists in the record
-        record = transform_process_instance(detail, forced_id=process_instance_id)
-        
-        # Temporary Debug: Print first few tasks or important fields
-        inst_status = record.get('status')
-        approvers = record.get('current_approvers')
-        
-        log_msg = f"Synced: {process_instance_id} | Status: {inst_status} | Approvers: {approvers} | Title: {record.get('title')}"
-        logger.info(log_msg)
-        
-        upsert_process_instance(record)
+        save_records([record])
+        logger.info("Synced: %s | Status: %s | Approvers: %s", process_instance_id,
+                    record.get('status'), record.get('current_approvers'),
+                    extra={'process_instance_id': process_instance_id, 'status': record.get('status')})
+        if clear_retry:
+            forget_failures([process_instance_id])
+        return True
     except Exception as e:
         logger.error(f"Failed to sync instance {process_instance_id}: {e}")
+        if record_failures:
+            record_failure(process_instance_id, e)
+        return False
+
+def sync_stream_instance(process_instance_id):
+    """Outbox sync function: retries are owned by the outbox until it gives up."""
+    return sync_single_instance(process_instance_id, record_failures=False)
+
+def save_records(records):
+    """Upsert records, through the tenant's write spool if one is configured (SPOOL_DIR)."""
+    spool = current_tenant().spool
+    if spool:
+        spool.write(records)
+    elif len(records) == 1:
+        upsert_process_instance(records[0])
+    else:
+        upsert_process_instances(records)
+
+def record_failure(process_instance_id, reason):
+    """Schedule a failed instance for retry (see retry_failed_syncs). Never raises."""
+    try:
+        record_sync_failure(
+            process_instance_id, reason,
+            base_delay=int(os.getenv('RETRY_BASE_DELAY', 60)),
+            max_delay=int(os.getenv('RETRY_MAX_DELAY', 21600))
+        )
+    except Exception as e:
+        logger.error(f"Failed to record sync failure for {process_instance_id}: {e}")
+
+def forget_failures(process_instance_ids):
+    """Drop pending retries of instances that are up to date again. Never raises."""
+    try:
+        clear_sync_failures(process_instance_ids)
+    except Exception as e:
+        logger.warning(f"Failed to clear sync failures: {e}")
 
 # --- User Sync ---
 
@@ -171,13 +258,13 @@ def sync_users():
     try:
         # 1. Get all departments
         logger.info("Fetching departments...")
-        dept_ids = dt_client.get_department_list_ids()
+        dept_ids = get_dt_client().get_department_list_ids()
         logger.info(f"Found {len(dept_ids)} departments.")
 
         # 2. Get users for each department
         all_users = []
         for i, dept_id in enumerate(dept_ids):
-            users = dt_client.get_dept_users(dept_id)
+            users = get_dt_client().get_dept_users(dept_id)
             all_users.extend(users)
             if i % 10 == 0:
                 logger.info(f"Processed {i+1}/{len(dept_ids)} departments...")
@@ -193,99 +280,386 @@ def sync_users():
     except Exception as e:
         logger.critical(f"Failed to sync users: {e}")
 
-# --- Stream Mode Handlers ---
+# --- Stream Mode ---
 
-class AllEventHandler(EventHandler):
+def start_stream_mode(tenants=None):
     """
-    Catch-all event handler to log all incoming events for debugging and processing.
-    This is the correct way to handle event subscriptions in DingTalk Stream mode.
+    One stream connection per tenant, each with its own outbox workers, token
+    refresher and retry scheduler. A single tenant runs on the calling thread.
     """
-    async def process(self, event):
-        """
-        Log all events that come through the stream and process BPMS events.
-        Event types are determined from event.headers (dict-like) containing 'eventType'.
-        """
-        # Extract event properties - different SDK versions may have different structures
-        headers = getattr(event, 'headers', {})
-        data = getattr(event, 'data', '{}')
-        
-        # headers might be a dict or an object with attributes
-        if isinstance(headers, dict):
-            event_type = headers.get('eventType') or headers.get('event_type', 'unknown')
-            topic = headers.get('topic', 'unknown')
-        else:
-            event_type = getattr(headers, 'eventType', None) or getattr(headers, 'event_type', 'unknown')
-            topic = getattr(headers, 'topic', 'unknown')
-        
-        logger.info(f"[AllEventHandler] *** EVENT RECEIVED ***")
-        logger.info(f"  EventType: {event_type}")
-        logger.info(f"  Topic: {topic}")
-        logger.info(f"  Headers: {headers}")
-        logger.info(f"  Data (first 500 chars): {str(data)[:500]}")
-        
-        # Process BPMS events (approval workflow events)
-        if event_type in ['bpms_instance_change', 'bpms_task_change'] or 'bpms' in str(event_type).lower():
-            try:
-                if isinstance(data, str):
-                    parsed_data = json.loads(data)
-                else:
-                    parsed_data = data
-                process_instance_id = parsed_data.get('processInstanceId')
-                if process_instance_id:
-                    logger.info(f"  -> Processing BPMS event, syncing instance: {process_instance_id}")
-                    # Run sync in executor to not block the async loop
-                    loop = asyncio.get_event_loop()
-                    await loop.run_in_executor(None, sync_single_instance, process_instance_id)
-            except Exception as e:
-                logger.error(f"  -> Error processing BPMS event: {e}")
-        
-        return AckMessage.STATUS_OK, 'OK'
+    tenants = tenants or select_tenants()
+    logger.info("Starting DingTalk Stream Mode...")
 
+    clients = []
+    for tenant in tenants:
+        with use_tenant(tenant):
+            client = _init_tenant_stream(tenant)
+        if client:
+            clients.append((tenant, client))
+    if not clients:
+        return
 
-def start_stream_mode():
-    logger.info("Starting DingTalk Stream Mode...")
-    
-    client_id = os.getenv('DINGTALK_CLIENT_ID')
-    client_secret = os.getenv('DINGTALK_CLIENT_SECRET')
-    
-    if not client_id or not client_secret:
-        logger.critical("DINGTALK_CLIENT_ID or DINGTALK_CLIENT_SECRET not set.")
+    if len(clients) == 1:
+        clients[0][1].start_forever()
         return
 
-    credential = Credential(client_id, client_secret)
+    for tenant, client in clients:
+        threading.Thread(target=client.start_forever, name=f"stream-{tenant.name}", daemon=True).start()
+    # Daemon threads: the process (and every connection) ends on Ctrl+C
+    while True:
+        time.sleep(60)
+
+def _init_tenant_stream(tenant, retry_scheduler=True):
+    """Start background workers for `tenant` and return its (not yet started) stream client."""
+    from dingtalk_stream import DingTalkStreamClient, Credential
+    from stream_handler import AllEventHandler
+
+    if not tenant.client_id or not tenant.client_secret:
+        logger.critical(f"Client ID or secret not set for tenant {tenant.name}.")
+        return None
+
+    credential = Credential(tenant.client_id, tenant.client_secret)
     client = DingTalkStreamClient(credential)
+
+    # Keep the access token warm so event syncs never wait on a refresh
+    get_dt_client().start_token_refresher()
+
+    # Drain events left over from the previous run, then keep processing new ones
+    # Once the outbox gives up on an event, sync_retry takes over (one owner at a time)
+    outbox = OutboxWorker(sync_stream_instance, on_exhausted=record_failure)
+    outbox.start()
+
+    # Periodically retry instances whose sync failed (daemon mode schedules retries itself)
+    if retry_scheduler:
+        start_retry_scheduler()
     
     # For event subscriptions (审批事件), use register_all_event_handler
     # The event type is determined from headers.event_type in the handler
     # NOTE: register_callback_handler is for chatbot callbacks, NOT for events
-    client.register_all_event_handler(AllEventHandler())
+    client.register_all_event_handler(AllEventHandler(outbox, tenant))
 
-    
-    logger.info("Stream Client Initialized. Listening for events...")
-    client.start_forever()
+    logger.info(f"Stream Client Initialized for tenant {tenant.name}. Listening for events...")
+    return client
+
+# --- Daemon Mode ---
+
+def start_daemon_mode(tenants=None):
+    """
+    Stream listener plus periodic incremental backfill, reconcile, retry and user
+    refresh for every tenant, in one process. All DingTalk calls of a tenant share
+    its rate budget (DINGTALK_QPS or qps, default DAEMON_QPS): stream events are
+    synced at live priority, scheduled jobs only get the capacity left over.
+    """
+    from scheduler import Scheduler
+    from dingtalk_client import api_priority, PRIORITY_BACKFILL
+
+    tenants = tenants or select_tenants()
+    logger.info("Starting Daemon Mode...")
+
+    backfill_days = int(os.getenv('DAEMON_BACKFILL_DAYS', 2))
+    jobs = [
+        ('backfill', float(os.getenv('DAEMON_BACKFILL_INTERVAL', 3600)), lambda: run_incremental_backfill(backfill_days)),
+        ('reconcile', float(os.getenv('DAEMON_RECONCILE_INTERVAL', 900)), start_reconcile_mode),
+        ('retry', float(os.getenv('RETRY_INTERVAL', 60)), retry_failed_syncs),
+        ('sync-users', float(os.getenv('DAEMON_USERS_INTERVAL', 86400)), sync_users),
+    ]
+
+    scheduler = Scheduler()
+    for tenant in tenants:
+        # Priorities only work on a shared budget; set it before the client is created
+        tenant.qps = tenant.qps or float(os.getenv('DAEMON_QPS', 20))
+        with use_tenant(tenant):
+            client = _init_tenant_stream(tenant, retry_scheduler=False)
+            if not client:
+                continue
+            threading.Thread(target=client.start_forever, name=f"stream-{tenant.name}", daemon=True).start()
+
+            with api_priority(PRIORITY_BACKFILL):
+                for name, interval, fn in jobs:
+                    scheduler.add(f"{name}[{tenant.name}]", interval, bind(fn))
+
+    scheduler.run_forever()
+
+def run_incremental_backfill(days):
+    """History sync of the last `days` days (including today) for each of the tenant's process codes."""
+    tenant = current_tenant()
+    if not tenant.process_codes:
+        logger.warning(f"No process codes configured for tenant {tenant.name}, skipping backfill.")
+        return
+    end_date = date.today()
+    start_date = end_date - timedelta(days=max(days - 1, 0))
+    for p_code in tenant.process_codes:
+        start_history_mode(start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), p_code)
 
 # --- History Mode ---
 
+_PIPELINE_DONE = object()
+
 def start_history_mode(start_date, end_date, process_code):
+    """
+    Pipelined backfill: ID pages are listed, fetched, transformed and written
+    concurrently through bounded queues, so the first rows land after the
+    first page and memory stays flat however long the range is.
+
+        lister -> id_queue -> fetchers (HISTORY_WORKERS) -> record_queue -> batch writer
+    """
+    from dingtalk_client import RateLimiter
+
     logger.info(f"Starting History Mode: {start_date} to {end_date} for Process Code: {process_code}")
-    
-    # 1. Get IDs
+
+    workers = int(os.getenv('HISTORY_WORKERS', 4))
+    batch_size = int(os.getenv('HISTORY_BATCH_SIZE', 50))
+    # Avoid rate limits (shared by listing and detail calls)
+    limiter = RateLimiter(float(os.getenv('HISTORY_QPS', 5)))
+
+    id_queue = queue.Queue(maxsize=workers * 20)
+    record_queue = queue.Queue(maxsize=batch_size * 2)
+    stats = {'listed': 0, 'skipped': 0, 'failed': 0, 'written': 0}
+    listing_failed = threading.Event()
+    stats_lock = threading.Lock()
+
+    def count(key, n=1):
+        with stats_lock:
+            stats[key] += n
+
+    def lister():
+        try:
+            pages = get_dt_client().iter_process_instance_id_pages(
+                f"{start_date} 00:00:00", f"{end_date} 23:59:59", process_code, limiter=limiter
+            )
+            for page in pages:
+                count('listed', len(page))
+                # Idempotency Check: one query per page, final instances are not re-fetched
+                try:
+                    statuses = get_instance_statuses(page)
+                except Exception as e:
+                    # Status unknown: fetch the whole page rather than drop it
+                    logger.warning(f"Status lookup failed, fetching all {len(page)} instances of the page: {e}")
+                    statuses = {}
+                for pid in page:
+                    if statuses.get(pid) in ['COMPLETED', 'TERMINATED']:
+                        count('skipped')
+                    else:
+                        id_queue.put(pid)
+        except Exception as e:
+            logger.critical(f"Failed to fetch IDs: {e}")
+            listing_failed.set()
+        finally:
+            for _ in range(workers):
+                id_queue.put(_PIPELINE_DONE)
+
+    def fetcher():
+        while True:
+            pid = id_queue.get()
+            if pid is _PIPELINE_DONE:
+                record_queue.put(_PIPELINE_DONE)
+                return
+            limiter.acquire()
+            try:
+                record = fetch_instance_record(pid)
+                reason = "Could not fetch details"
+            except Exception as e:
+                record, reason = None, e
+            if record:
+                record_queue.put(record)
+            else:
+                logger.error(f"Failed to sync instance {pid}: {reason}")
+                record_failure(pid, reason)
+                count('failed')
+
+    def flush(batch):
+        try:
+            save_records(batch)
+            count('written', len(batch))
+            forget_failures([r['process_instance_id'] for r in batch])
+        except Exception:
+            # Isolate the bad record(s) instead of losing the whole batch
+            for record in batch:
+                try:
+                    save_records([record])
+                    count('written')
+                    forget_failures([record['process_instance_id']])
+                except Exception as e:
+                    logger.error(f"Failed to sync instance {record.get('process_instance_id')}: {e}")
+                    record_failure(record.get('process_instance_id'), e)
+                    count('failed')
+        logger.info(f"Progress: listed {stats['listed']}, written {stats['written']}, "
+                    f"skipped {stats['skipped']}, failed {stats['failed']}")
+
+    # Threads don't inherit the tenant context, bind() carries it over
+    threads = [threading.Thread(target=bind(lister), name="history-lister", daemon=True)]
+    threads += [threading.Thread(target=bind(fetcher), name=f"history-fetcher-{i}", daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+
+    # Batch writer runs on the calling thread
+    batch = []
+    finished_fetchers = 0
+    while finished_fetchers < workers:
+        try:
+            item = record_queue.get(timeout=1)
+        except queue.Empty:
+            item = None
+        if item is _PIPELINE_DONE:
+            finished_fetchers += 1
+        elif item is not None:
+            batch.append(item)
+        if batch and (len(batch) >= batch_size or item is None or finished_fetchers == workers):
+            flush(batch)
+            batch = []
+
+    for t in threads:
+        t.join()
+
+    summary = (f"Listed: {stats['listed']}, Written: {stats['written']}, "
+               f"Skipped: {stats['skipped']}, Failed: {stats['failed']}")
+    if listing_failed.is_set():
+        logger.error(f"History Sync Incomplete, listing stopped early. {summary}")
+    else:
+        logger.info(f"History Sync Completed. {summary}")
+
+# --- Reconcile Mode ---
+
+def start_reconcile_mode(max_instances=None, max_seconds=None):
+    """
+    Refresh in-flight (NEW/RUNNING) instances, least recently synced first.
+    Catches stream events that were missed without re-listing whole date ranges.
+    Stops once `max_instances` have been refreshed or `max_seconds` have passed.
+    """
+    max_instances = max_instances or int(os.getenv('RECONCILE_MAX_INSTANCES', 1000))
+    max_seconds = max_seconds or float(os.getenv('RECONCILE_MAX_SECONDS', 600))
+    workers = int(os.getenv('RECONCILE_WORKERS', 4))
+    from dingtalk_client import RateLimiter
+
+    limiter = RateLimiter(float(os.getenv('RECONCILE_QPS', 5)))
+    deadline = time.monotonic() + max_seconds
+
+    logger.info(f"Starting Reconcile Mode: up to {max_instances} instances within {max_seconds:.0f}s")
+
     try:
-        ids = dt_client.get_process_instance_ids(f"{start_date} 00:00:00", f"{end_date} 23:59:59", process_code)
-        logger.info(f"Found {len(ids)} instances.")
+        ids = get_inflight_instance_ids(max_instances)
+        logger.info(f"Found {len(ids)} in-flight instances.")
     except Exception as e:
-        logger.critical(f"Failed to fetch IDs: {e}")
+        logger.critical(f"Failed to fetch in-flight instances: {e}")
         return
 
-    # 2. Iterate and Sync
-    total = len(ids)
-    for i, pid in enumerate(ids):
-        logger.info(f"Syncing {i+1}/{total}...")
-        sync_single_instance(pid)
-        # Avoid rate limits
-        time.sleep(0.2)
+    def refresh(pid):
+        if time.monotonic() >= deadline:
+            return None
+        limiter.acquire()
+        return sync_single_instance(pid)
+
+    synced = failed = 0
+    batch_size = workers * 10
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(ids), batch_size):
+            if time.monotonic() >= deadline:
+                logger.warning("Reconcile time budget exhausted, stopping early.")
+                break
+            for ok in pool.map(bind(refresh), ids[start:start + batch_size]):
+                if ok:
+                    synced += 1
+                elif ok is False:
+                    failed += 1
+            logger.info(f"Reconciled {min(start + batch_size, len(ids))}/{len(ids)}...")
+
+    logger.info(f"Reconcile Completed. Synced: {synced}, Failed: {failed}, Skipped: {len(ids) - synced - failed}")
+
+# --- Retry / Dead Letter ---
+
+def retry_failed_syncs(limit=None):
+    """
+    Retry one batch of failed instance syncs whose backoff has expired.
+    Instances that still fail after RETRY_MAX_ATTEMPTS are parked in `sync_dead_letter`.
+    Returns: number of due instances processed.
+    """
+    from dingtalk_client import RateLimiter
+
+    limit = limit or int(os.getenv('RETRY_BATCH_SIZE', 100))
+    max_attempts = int(os.getenv('RETRY_MAX_ATTEMPTS', 8))
+    limiter = RateLimiter(float(os.getenv('RETRY_QPS', 5)))
+
+    try:
+        due = get_due_retries(limit)
+    except Exception as e:
+        logger.error(f"Failed to fetch due retries: {e}")
+        return 0
+
+    recovered = dead = 0
+    for row in due:
+        pid = row['process_instance_id']
+        limiter.acquire()
+        try:
+            # sync_single_instance clears the entry on success, bumps attempts and reschedules on failure
+            if sync_single_instance(pid, clear_retry=True):
+                recovered += 1
+            elif row['attempts'] + 1 >= max_attempts:
+                move_to_dead_letter(pid)
+                dead += 1
+                logger.warning(f"Giving up on {pid} after {row['attempts'] + 1} attempts, moved to dead letter.")
+        except Exception as e:
+            logger.error(f"Failed to update retry state for {pid}: {e}")
+
+    if due:
+        logger.info(f"Retried {len(due)} failed syncs. Recovered: {recovered}, Dead: {dead}")
+    return len(due)
+
+def start_retry_mode():
+    """Retry due failures batch by batch until none are due."""
+    logger.info("Starting Retry Mode...")
+    limit = int(os.getenv('RETRY_BATCH_SIZE', 100))
+    while retry_failed_syncs(limit) >= limit:
+        pass
+    logger.info("Retry Completed.")
+
+def start_retry_scheduler():
+    """Run retry_failed_syncs every RETRY_INTERVAL seconds in a background thread."""
+    interval = float(os.getenv('RETRY_INTERVAL', 60))
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            retry_failed_syncs()
+
+    threading.Thread(target=bind(loop), name="retry-scheduler", daemon=True).start()
+    logger.info(f"Retry scheduler started (every {interval:.0f}s).")
+
+def dead_letter_command(args):
+    """
+    dead-letter [list]              Show parked failures
+    dead-letter replay <id|all>     Re-sync parked instances
+    """
+    action = args[0] if args else 'list'
 
-    logger.info("History Sync Completed.")
+    if action == 'list':
+        rows = get_dead_letters(int(args[1]) if len(args) >= 2 else 100)
+        if not rows:
+            print("Dead letter table is empty.")
+            return
+        print("\n=== Dead Letter ===")
+        for r in rows:
+            print(f"{r['process_instance_id']} | attempts: {r['attempts']} | parked: {r['dead_time']} | {r['reason']}")
+        print("===================\n")
+
+    elif action == 'replay':
+        if len(args) < 2:
+            logger.error("Usage: python main.py dead-letter replay <process_instance_id|all>")
+            return
+        if args[1] == 'all':
+            ids = [r['process_instance_id'] for r in get_dead_letters(1000000)]
+        else:
+            ids = [args[1]]
+
+        replayed = 0
+        for pid in ids:
+            # A failed replay goes back to the retry queue with fresh backoff
+            delete_dead_letter(pid)
+            if sync_single_instance(pid):
+                replayed += 1
+        logger.info(f"Replayed {replayed}/{len(ids)} dead-lettered instances.")
+
+    else:
+        logger.error(f"Unknown dead-letter action: {action}")
 
 def list_process_codes():
     """
@@ -294,13 +668,13 @@ def list_process_codes():
     logger.info("Discovering Process Codes...")
     try:
         # 1. Get a department (root)
-        dept_ids = dt_client.get_department_list_ids()
+        dept_ids = get_dt_client().get_department_list_ids()
         if not dept_ids:
             logger.error("No departments found.")
             return
 
         # 2. Get a user from the first department
-        users = dt_client.get_dept_users(dept_ids[0])
+        users = get_dt_client().get_dept_users(dept_ids[0])
         if not users:
             logger.error("No users found in root department to query process list.")
             return
@@ -309,7 +683,7 @@ def list_process_codes():
         logger.info(f"Using user {users[0]['name']} ({test_user_id}) to query template list...")
         
         # 3. Get process list
-        process_list = dt_client.get_user_visible_process_codes(test_user_id)
+        process_list = get_dt_client().get_user_visible_process_codes(test_user_id)
         
         if not process_list:
             logger.warning("No accessible process codes found for this user.")
@@ -325,55 +699,169 @@ def list_process_codes():
     except Exception as e:
         logger.error(f"Failed to list process codes: {e}")
 
+def run_tenant_jobs(jobs):
+    """
+    Run `jobs` ([(tenant, fn, args), ...]) with at most TENANT_CONCURRENCY running at once,
+    each under its own tenant. Started in list order, so callers interleave tenants
+    (see interleave_jobs) to keep one organization's backlog from starving the others.
+    """
+    if len(jobs) == 1:
+        tenant, fn, args = jobs[0]
+        with use_tenant(tenant):
+            fn(*args)
+        return
+
+    def run(job):
+        tenant, fn, args = job
+        try:
+            bind(fn, tenant)(*args)
+        except Exception as e:
+            logger.error(f"Job {fn.__name__} failed for tenant {tenant.name}: {e}")
+
+    with ThreadPoolExecutor(max_workers=int(os.getenv('TENANT_CONCURRENCY', 4))) as pool:
+        list(pool.map(run, jobs))
+
+def interleave_jobs(jobs_per_tenant):
+    """Round-robin merge of per-tenant job lists: [a1, b1, a2, b2, a3, ...]."""
+    merged = []
+    for i in range(max((len(jobs) for jobs in jobs_per_tenant), default=0)):
+        merged.extend(jobs[i] for jobs in jobs_per_tenant if i < len(jobs))
+    return merged
+
 def main():
-    # Initialize DB
-    create_table_if_not_exists()
-    
+    setup_logging()
+
     if len(sys.argv) < 2:
         print("Usage:")
         print("  python main.py stream")
+        print("  python main.py daemon  <-- Stream + scheduled backfill/reconcile/retry/user refresh")
         print("  python main.py history <start_date> <end_date> [process_code]")
         print("  python main.py history (defaults to last month)")
         print("  python main.py list-codes  <-- Use to find your PROCESS_CODE")
         print("  python main.py sync-users  <-- Cache Users")
+        print("  python main.py reconcile [max_instances] [max_seconds]  <-- Refresh in-flight instances")
+        print("  python main.py retry  <-- Retry failed instance syncs that are due")
+        print("  python main.py dead-letter [list | replay <process_instance_id|all>]")
+        print("  python main.py outbox-requeue  <-- Retry stream events that exhausted OUTBOX_MAX_ATTEMPTS")
+        print("  python main.py export <out_dir> [csv|parquet] [full]  <-- Export for analytics")
+        print("  python main.py partition [months_ahead]  <-- Partition process_instance by month")
+        print("  python main.py archive [cutoff_date] [batch_size]  <-- Move old finished instances to archive")
+        print("  python main.py drain-spool  <-- Replay records spooled while MySQL was unavailable")
         return
 
+    try:
+        tenants = select_tenants()
+    except Exception as e:
+        logger.critical(f"Failed to load tenants: {e}")
+        return
+
+    # Initialize DB of every tenant (no-op when the schema version is current)
+    for tenant in tenants:
+        with use_tenant(tenant):
+            create_table_if_not_exists()
+
     mode = sys.argv[1]
-    
+
+    # Commands that read or write one tenant's data interactively
+    if mode in ('list-codes', 'dead-letter', 'archive', 'export') and len(tenants) > 1:
+        logger.error(f"'{mode}' works on one tenant at a time. Set TENANT=<name>.")
+        return
+
     if mode == 'stream':
-        start_stream_mode()
+        start_stream_mode(tenants)
+
+    elif mode == 'daemon':
+        start_daemon_mode(tenants)
 
     elif mode == 'list-codes':
         list_process_codes()
 
     elif mode == 'sync-users':
-        sync_users()
+        run_tenant_jobs([(t, sync_users, ()) for t in tenants])
+
+    elif mode == 'reconcile':
+        max_instances = int(sys.argv[2]) if len(sys.argv) >= 3 else None
+        max_seconds = float(sys.argv[3]) if len(sys.argv) >= 4 else None
+        run_tenant_jobs([(t, start_reconcile_mode, (max_instances, max_seconds)) for t in tenants])
+
+    elif mode == 'retry':
+        run_tenant_jobs([(t, start_retry_mode, ()) for t in tenants])
+
+    elif mode == 'dead-letter':
+        dead_letter_command(sys.argv[2:])
+
+    elif mode == 'outbox-requeue':
+        for tenant in tenants:
+            with use_tenant(tenant):
+                logger.info(f"Requeued {requeue_failed_events()} failed outbox events for tenant {tenant.name}.")
+
+    elif mode == 'partition':
+        months_ahead = int(sys.argv[2]) if len(sys.argv) >= 3 else int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+        for tenant in tenants:
+            with use_tenant(tenant):
+                try:
+                    manage_partitions(months_ahead)
+                except Exception as e:
+                    logger.critical(f"Partitioning Failed for tenant {tenant.name}: {e}")
+
+    elif mode == 'archive':
+        if len(sys.argv) >= 3:
+            cutoff = sys.argv[2]
+        else:
+            from dateutil.relativedelta import relativedelta
+            months = int(os.getenv('ARCHIVE_AFTER_MONTHS', 12))
+            cutoff = (date.today().replace(day=1) - relativedelta(months=months)).strftime('%Y-%m-%d')
+        batch_size = int(sys.argv[3]) if len(sys.argv) >= 4 else int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+        logger.info(f"Archiving finished instances created before {cutoff}...")
+        try:
+            total = archive_finished_instances(cutoff, batch_size)
+            logger.info(f"Archive Completed. {total} instances moved to process_instance_archive.")
+        except Exception as e:
+            logger.critical(f"Archive Failed: {e}")
+
+    elif mode == 'drain-spool':
+        for tenant in tenants:
+            with use_tenant(tenant):
+                if not tenant.spool:
+                    logger.error("SPOOL_DIR is not set.")
+                    return
+                try:
+                    tenant.spool.drain()
+                except Exception as e:
+                    logger.critical(f"Spool Replay Failed for tenant {tenant.name}: {e}")
+
+    elif mode == 'export':
+        from export import export_instances
+
+        if len(sys.argv) < 3:
+            logger.error("Usage: python main.py export <out_dir> [csv|parquet] [full]")
+            return
+        fmt = sys.argv[3] if len(sys.argv) >= 4 else 'csv'
+        full = len(sys.argv) >= 5 and sys.argv[4] == 'full'
+        try:
+            export_instances(sys.argv[2], fmt, full)
+        except Exception as e:
+            logger.critical(f"Export Failed: {e}")
         
     elif mode == 'history':
-        process_code_env = os.getenv('PROCESS_CODE', '')
-        
-        # Parse process codes: split by comma, strip whitespace, remove comments (starting with #)
-        env_codes = [p.strip() for p in process_code_env.split(',') if p.strip() and not p.strip().startswith('#')]
-
         if len(sys.argv) >= 4:
             start_date = sys.argv[2]
             end_date = sys.argv[3]
-            # Priority: Arg > Env
-            if len(sys.argv) >= 5:
-                process_codes = [sys.argv[4]]
-            else:
-                process_codes = env_codes
         else:
             start_date, end_date = get_last_month_range()
-            process_codes = env_codes
-            
-        if not process_codes:
-            logger.critical("Process Code is required for history mode. Set PROCESS_CODE env var (comma separated) or pass as argument.")
-            logger.info("Tip: Run 'python main.py list-codes' to see available codes.")
-            return
-        
-        for p_code in process_codes:
-            start_history_mode(start_date, end_date, p_code)
+
+        # Process codes per tenant (PROCESS_CODE / TENANTS_FILE). Priority: Arg > Config
+        jobs_per_tenant = []
+        for tenant in tenants:
+            process_codes = [sys.argv[4]] if len(sys.argv) >= 5 else tenant.process_codes
+            if not process_codes:
+                logger.critical(f"Process Code is required for history mode (tenant {tenant.name}). Set PROCESS_CODE env var (comma separated) or pass as argument.")
+                logger.info("Tip: Run 'python main.py list-codes' to see available codes.")
+                continue
+            jobs_per_tenant.append([(tenant, start_history_mode, (start_date, end_date, p_code)) for p_code in process_codes])
+
+        # One (tenant, process code) range per job, tenants taking turns
+        run_tenant_jobs(interleave_jobs(jobs_per_tenant))
         
     else:
         logger.error(f"Unknown mode: {mode}")
@@ -0,0 +1,98 @@
+import os
+import time
+import logging
+import threading
+
+from db import claim_pending_events, complete_event, fail_event, purge_done_events
+from tenants import bind
+
+logger = logging.getLogger(__name__)
+
+class OutboxWorker:
+    """
+    Drains the `event_outbox` table with a small pool of threads.
+    Stream events are written to the outbox before they are acked,
+    so anything received before a crash/restart is picked up here: claims are
+    leased (OUTBOX_LEASE_SECONDS) and reclaimed by any worker once they expire.
+    Failed events are retried with exponential backoff (OUTBOX_RETRY_BASE_DELAY,
+    OUTBOX_RETRY_MAX_DELAY) and parked as FAILED after OUTBOX_MAX_ATTEMPTS;
+    `on_exhausted(process_instance_id, error)` is then called to hand the instance
+    over to another retry mechanism.
+    """
+    def __init__(self, sync_fn, workers=None, batch_size=None, poll_interval=None, max_attempts=None,
+                 on_exhausted=None):
+        self.sync_fn = sync_fn
+        self.on_exhausted = on_exhausted
+        self.workers = workers or int(os.getenv('OUTBOX_WORKERS', 4))
+        self.batch_size = batch_size or int(os.getenv('OUTBOX_BATCH_SIZE', 10))
+        self.poll_interval = poll_interval or float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+        self.max_attempts = max_attempts or int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+        self.retry_base_delay = int(os.getenv('OUTBOX_RETRY_BASE_DELAY', 5))
+        self.retry_max_delay = int(os.getenv('OUTBOX_RETRY_MAX_DELAY', 300))
+        # A claimed row is reclaimable after this long (worker died or couldn't record the outcome)
+        self.lease_seconds = int(os.getenv('OUTBOX_LEASE_SECONDS', 300))
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads (they drain any backlog first, including events whose
+        lease expired in a previous run). Workers serve the tenant active when start() is called.
+        """
+        purge_done_events()
+        for i in range(self.workers):
+            t = threading.Thread(target=bind(self._run), name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"Outbox worker started with {self.workers} threads.")
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join()
+
+    def notify(self):
+        """Wake idle workers after a new event was enqueued."""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                rows = claim_pending_events(self.batch_size, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Outbox claim failed: {e}")
+                rows = []
+
+            if not rows:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            for row in rows:
+                self._process(row['process_instance_id'], row['seq'])
+
+    def _process(self, process_instance_id, seq):
+        try:
+            ok = self.sync_fn(process_instance_id)
+            error = None if ok else "sync failed"
+        except Exception as e:
+            ok, error = False, e
+
+        for attempt in range(4):
+            try:
+                if ok:
+                    complete_event(process_instance_id, seq)
+                else:
+                    parked = fail_event(process_instance_id, seq, error, self.max_attempts,
+                                        self.retry_base_delay, self.retry_max_delay)
+                    if parked and self.on_exhausted:
+                        self.on_exhausted(process_instance_id, error)
+                return
+            except Exception as e:
+                logger.error(f"Failed to update outbox state for {process_instance_id}: {e}")
+                if attempt < 3:
+                    time.sleep(2 ** attempt)
+        # Row stays PROCESSING until its lease expires, then it is claimed again
+
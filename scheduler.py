@@ -0,0 +1,49 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    """
+    Runs periodic jobs on a small thread pool (DAEMON_WORKERS).
+    A job is due again `interval` seconds after its previous run finished,
+    so a slow run never overlaps with itself; due jobs start oldest first.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or int(os.getenv('DAEMON_WORKERS', 2))
+        self._jobs = []  # heap of (due, seq, name, interval, fn)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def add(self, name, interval, fn, delay=0):
+        """Run `fn()` every `interval` seconds, first after `delay` seconds."""
+        self._push(time.monotonic() + delay, name, interval, fn)
+        logger.info(f"Scheduled {name} every {interval:.0f}s.")
+
+    def _push(self, due, name, interval, fn):
+        with self._cond:
+            heapq.heappush(self._jobs, (due, next(self._seq), name, interval, fn))
+            self._cond.notify()
+
+    def run_forever(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scheduler') as pool:
+            while True:
+                with self._cond:
+                    while not self._jobs or self._jobs[0][0] > time.monotonic():
+                        self._cond.wait(self._jobs[0][0] - time.monotonic() if self._jobs else None)
+                    _, _, name, interval, fn = heapq.heappop(self._jobs)
+                pool.submit(self._run, name, interval, fn)
+
+    def _run(self, name, interval, fn):
+        started = time.monotonic()
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Scheduled job {name} failed: {e}")
+        logger.info(f"Scheduled job {name} finished in {time.monotonic() - started:.1f}s.")
+        self._push(time.monotonic() + interval, name, interval, fn)
@@ -0,0 +1,275 @@
+import os
+import json
+import glob
+import time
+import atexit
+import shutil
+import logging
+import threading
+
+import pymysql
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from db import upsert_process_instances
+from tenants import bind
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = '.lock'
+
+def _try_lock(path):
+    """Open `path` with a non-blocking exclusive lock. Returns the open file, or None if it is held elsewhere."""
+    try:
+        f = open(path, 'a+')
+    except OSError:
+        return None
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+class WriteSpool:
+    """
+    Local fallback for process_instance upserts (enabled by SPOOL_DIR).
+    Records whose DB write fails or times out are appended to on-disk segments;
+    a drainer thread replays them in bulk once MySQL answers again. While anything
+    is spooled, new records are spooled too, so this process's own writes stay in
+    order. Rows written meanwhile by other processes are protected by the upsert
+    itself: a replayed snapshot never moves a finished instance back to a
+    non-final status (see PROCESS_INSTANCE_UPSERT_SQL).
+
+    Appends are fsynced in batches (group commit): writers wait at most
+    SPOOL_FSYNC_INTERVAL for one fsync that covers every append since the last one.
+
+    Several processes may share `directory`: each one appends to its own
+    sub-directory (<directory>/<pid>) and holds an exclusive lock on it while it
+    runs. Only sub-directories whose lock is free (their process exited) are
+    replayed by other processes, never a segment that is still being written.
+    """
+    def __init__(self, directory, db_timeout=None, segment_bytes=None, fsync_interval=None,
+                 drain_interval=None, drain_batch=None):
+        self.directory = directory
+        self.db_timeout = db_timeout or float(os.getenv('SPOOL_DB_TIMEOUT', 5))
+        self.segment_bytes = segment_bytes or int(os.getenv('SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024))
+        self.fsync_interval = fsync_interval or float(os.getenv('SPOOL_FSYNC_INTERVAL', 0.05))
+        self.drain_interval = drain_interval or float(os.getenv('SPOOL_DRAIN_INTERVAL', 5))
+        self.drain_batch = drain_batch or int(os.getenv('SPOOL_DRAIN_BATCH', 500))
+
+        self._file = None  # active segment, opened on first append
+        self._own_dir, self._owner_lock = self._claim_own_dir()
+        existing = self._segments()
+        self._next_segment = int(os.path.basename(existing[-1]).split('.')[0]) + 1 if existing else 1
+        # Segments left by earlier processes are replayed before direct writes resume
+        self._backlog = bool(existing) or any(self._dir_segments(d) for d in self._peer_dirs())
+
+        self._appended = 0  # appends so far
+        self._fsynced = 0   # appends covered by an fsync
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._dirty = threading.Event()
+        # Held while a segment is being fsynced or rotated, so it isn't closed mid-fsync
+        self._fsync_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Start the fsync and drain threads (they serve the tenant active when called)."""
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=bind(self._flush_loop), name="spool-fsync", daemon=True).start()
+        threading.Thread(target=bind(self._drain_loop), name="spool-drain", daemon=True).start()
+        atexit.register(self.close)
+        if self._backlog:
+            logger.warning(f"Found spooled segments in {self.directory}, replaying.")
+
+    def close(self):
+        """Close the active segment; remove this process's sub-directory if nothing is left to replay."""
+        self._rotate()
+        with self._lock:
+            if self._file is None and not self._segments() and self._owner_lock:
+                self._owner_lock.close()
+                self._owner_lock = None
+                shutil.rmtree(self._own_dir, ignore_errors=True)
+
+    def write(self, records):
+        """Upsert `records`, or spool them if MySQL is slow/unavailable or a backlog is pending."""
+        if not self._backlog:
+            try:
+                upsert_process_instances(records, timeout=self.db_timeout)
+                return
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+                logger.warning(f"DB write failed, spooling {len(records)} records: {e}")
+        self.append(records)
+
+    def append(self, records):
+        """Append records to the active segment; returns once they are fsynced."""
+        lines = ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in records)
+        with self._lock:
+            if self._file is None:
+                path = os.path.join(self._own_dir, f"{self._next_segment:012d}.seg")
+                self._next_segment += 1
+                self._file = open(path, 'a', encoding='utf-8')
+            self._file.write(lines)
+            self._appended += 1
+            seq = self._appended
+            self._backlog = True
+            self._dirty.set()
+            while self._fsynced < seq:
+                self._synced.wait()
+
+    def drain(self):
+        """Replay every spooled record to MySQL, oldest first. Raises if the DB is still failing."""
+        with self._drain_lock:
+            self._drain()
+
+    def _drain(self):
+        # Segments of exited processes first: they are older than anything written here
+        for peer_dir in self._peer_dirs():
+            lock = _try_lock(os.path.join(peer_dir, LOCK_FILE))
+            if not lock:
+                continue  # its process is running (again) and replays them itself
+            try:
+                for path in self._dir_segments(peer_dir):
+                    self._replay_segment(path)
+            finally:
+                lock.close()
+            shutil.rmtree(peer_dir, ignore_errors=True)
+
+        self._rotate()
+        for path in self._segments():
+            self._replay_segment(path)
+
+        with self._lock:
+            # Anything appended meanwhile opened a new segment and keeps the backlog flag
+            if self._backlog and self._file is None and not self._segments():
+                self._backlog = False
+                logger.info("Spool drained, writing to the database directly again.")
+
+    def _replay_segment(self, path):
+        total = 0
+        for batch in self._read_batches(path):
+            self._replay(batch)
+            total += len(batch)
+        # A segment that fails halfway is replayed whole next time; upserts are idempotent
+        os.remove(path)
+        logger.info(f"Replayed {total} spooled records from {path}.")
+
+    def _replay(self, batch):
+        try:
+            upsert_process_instances(batch, timeout=self.db_timeout)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            raise
+        except Exception:
+            # Isolate the bad record(s) so they can't block the rest of the spool
+            for record in batch:
+                try:
+                    upsert_process_instances([record], timeout=self.db_timeout)
+                except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+                    raise
+                except Exception as e:
+                    logger.error(f"Dropping spooled record {record.get('process_instance_id')}: {e}")
+
+    def _claim_own_dir(self):
+        """Create and lock this process's sub-directory. Returns (path, open lock file)."""
+        own_dir = os.path.join(self.directory, str(os.getpid()))
+        os.makedirs(own_dir, exist_ok=True)
+        lock = _try_lock(os.path.join(own_dir, LOCK_FILE))
+        if not lock:
+            raise RuntimeError(f"Spool directory {own_dir} is locked by another process")
+        return own_dir, lock
+
+    def _segments(self):
+        """Closed segments of this process, oldest first."""
+        active = self._file.name if self._file else None
+        return [p for p in sorted(glob.glob(os.path.join(self._own_dir, '*.seg'))) if p != active]
+
+    def _peer_dirs(self):
+        """Sub-directories of other processes, running or exited, oldest segments first."""
+        dirs = [d for d in glob.glob(os.path.join(self.directory, '*'))
+                if os.path.isdir(d) and d != self._own_dir]
+        return sorted(dirs, key=self._oldest_mtime)
+
+    @classmethod
+    def _oldest_mtime(cls, path):
+        mtimes = []
+        for p in cls._dir_segments(path):
+            try:
+                mtimes.append(os.path.getmtime(p))
+            except OSError:
+                continue  # removed by the peer replaying it
+        return min(mtimes, default=0)
+
+    @staticmethod
+    def _dir_segments(path):
+        return sorted(glob.glob(os.path.join(path, '*.seg')))
+
+    def _read_batches(self, path):
+        batch = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    # Torn last line after a crash: its append never returned, so nothing was acked
+                    logger.warning(f"Skipping unreadable line in {os.path.basename(path)}")
+                    continue
+                if len(batch) >= self.drain_batch:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _rotate(self):
+        """Close the active segment so the drainer can replay it."""
+        with self._fsync_lock, self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._fsynced = self._appended
+            self._synced.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            self._dirty.wait()
+            # Let concurrent appends pile up behind one fsync
+            time.sleep(self.fsync_interval)
+            with self._fsync_lock:
+                with self._lock:
+                    self._dirty.clear()
+                    if self._file is None:
+                        continue
+                    self._file.flush()
+                    target, f = self._appended, self._file
+                os.fsync(f.fileno())
+                with self._lock:
+                    self._fsynced = max(self._fsynced, target)
+                    self._synced.notify_all()
+                    full = self._file is not None and self._file.tell() >= self.segment_bytes
+            if full:
+                self._rotate()
+
+    def _drain_loop(self):
+        while True:
+            time.sleep(self.drain_interval)
+            try:
+                # Also picks up sub-directories left behind by processes that exited
+                if not self._backlog and not self._peer_dirs():
+                    continue
+                self.drain()
+            except Exception as e:
+                logger.warning(f"Spool replay paused, will retry in {self.drain_interval:.0f}s: {e}")
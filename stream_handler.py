@@ -0,0 +1,80 @@
+import os
+import asyncio
+import json
+import logging
+
+# DingTalk Stream SDK
+from dingtalk_stream import EventHandler, AckMessage
+
+from db import enqueue_event
+from tenants import bind
+from log_config import LogSampler
+
+logger = logging.getLogger(__name__)
+
+# Full header/payload dumps are rate limited, everything else is one line per event
+_payload_sampler = LogSampler(int(os.getenv('LOG_EVENT_PAYLOADS_PER_MINUTE', 6)), 60)
+
+class AllEventHandler(EventHandler):
+    """
+    Catch-all event handler to log all incoming events for debugging and processing.
+    This is the correct way to handle event subscriptions in DingTalk Stream mode.
+    BPMS events are written to the durable outbox before the ack; the actual
+    sync is done by the OutboxWorker.
+    """
+    def __init__(self, outbox=None, tenant=None):
+        super().__init__()
+        self.outbox = outbox
+        # Organization this stream connection belongs to (None: default tenant)
+        self.tenant = tenant
+
+    async def process(self, event):
+        """
+        Log all events that come through the stream and process BPMS events.
+        Event types are determined from event.headers (dict-like) containing 'eventType'.
+        """
+        # Extract event properties - different SDK versions may have different structures
+        headers = getattr(event, 'headers', {})
+        data = getattr(event, 'data', '{}')
+        
+        # headers might be a dict or an object with attributes
+        if isinstance(headers, dict):
+            event_type = headers.get('eventType') or headers.get('event_type', 'unknown')
+            topic = headers.get('topic', 'unknown')
+        else:
+            event_type = getattr(headers, 'eventType', None) or getattr(headers, 'event_type', 'unknown')
+            topic = getattr(headers, 'topic', 'unknown')
+        
+        logger.debug("Event received: %s (topic %s)", event_type, topic)
+        allowed, suppressed = _payload_sampler.allow()
+        if allowed:
+            logger.info("[AllEventHandler] Sample event (%d not shown since last sample) | Type: %s | Topic: %s | Headers: %s | Data (first 500 chars): %s",
+                        suppressed, event_type, topic, headers, str(data)[:500])
+        
+        # Process BPMS events (approval workflow events)
+        if event_type in ['bpms_instance_change', 'bpms_task_change'] or 'bpms' in str(event_type).lower():
+            try:
+                if isinstance(data, str):
+                    parsed_data = json.loads(data)
+                else:
+                    parsed_data = data
+                process_instance_id = parsed_data.get('processInstanceId')
+            except Exception as e:
+                # Malformed payload, redelivery won't help
+                logger.error(f"Error parsing BPMS event: {e}")
+                return AckMessage.STATUS_OK, 'OK'
+
+            if process_instance_id:
+                logger.info("Queued %s for instance %s", event_type, process_instance_id,
+                            extra={'event_type': event_type, 'process_instance_id': process_instance_id})
+                try:
+                    # Persist before acking; DB I/O runs in executor to not block the async loop
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(None, bind(enqueue_event, self.tenant), process_instance_id, str(event_type))
+                except Exception as e:
+                    logger.error(f"Failed to persist BPMS event, asking for redelivery: {e}")
+                    return AckMessage.STATUS_SYSTEM_EXCEPTION, 'outbox unavailable'
+                if self.outbox:
+                    self.outbox.notify()
+        
+        return AckMessage.STATUS_OK, 'OK'
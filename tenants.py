@@ -0,0 +1,176 @@
+import os
+import json
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class Tenant:
+    """
+    One DingTalk organization: credentials, process codes, target database and
+    its own token cache (DingTalkClient), API rate limiter and user resolver.
+    """
+    def __init__(self, name, client_id, client_secret, process_codes=None, db_name=None, qps=None):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.process_codes = process_codes or []
+        self.db_name = db_name or os.getenv('DB_NAME', '工程信息')
+        # Per-app API budget shared by all of this tenant's calls (unset: unlimited)
+        qps = qps or os.getenv('DINGTALK_QPS')
+        self.qps = float(qps) if qps else None
+        self._client = None
+        self._resolver = None
+        self._spool = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Tenant({self.name})"
+
+    @property
+    def client(self):
+        """DingTalkClient for this tenant, created on first use."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from dingtalk_client import DingTalkClient, RateLimiter
+                    self._client = DingTalkClient(
+                        self.client_id, self.client_secret,
+                        rate_limiter=RateLimiter(self.qps) if self.qps else None
+                    )
+        return self._client
+
+    @property
+    def resolver(self):
+        """UserResolver for this tenant (separate negative cache per organization)."""
+        if self._resolver is None:
+            with self._lock:
+                if self._resolver is None:
+                    from user_resolver import UserResolver
+                    self._resolver = UserResolver(lambda: self.client)
+        return self._resolver
+
+    @property
+    def spool(self):
+        """
+        WriteSpool for this tenant's process_instance writes, in SPOOL_DIR/<name>.
+        None unless SPOOL_DIR is set. Its drainer starts on first use.
+        """
+        if self._spool is None and os.getenv('SPOOL_DIR'):
+            with self._lock:
+                if self._spool is None:
+                    from spool import WriteSpool
+                    spool = WriteSpool(os.path.join(os.getenv('SPOOL_DIR'), self.name))
+                    with use_tenant(self):
+                        spool.start()
+                    self._spool = spool
+        return self._spool
+
+def parse_process_codes(value):
+    """Split a comma separated PROCESS_CODE value, dropping blanks and comments (starting with #)."""
+    if isinstance(value, list):
+        return value
+    return [p.strip() for p in (value or '').split(',') if p.strip() and not p.strip().startswith('#')]
+
+_tenants = None
+_tenants_lock = threading.Lock()
+
+def load_tenants():
+    """
+    Load tenant configs once.
+    TENANTS_FILE: JSON list of {"name", "client_id", "client_secret", "process_codes", "db_name", "qps"}.
+    Every entry needs its own `db_name`: tables carry no tenant column, so organizations never share a database.
+    Without it, a single "default" tenant is built from the usual .env settings.
+    """
+    global _tenants
+    if _tenants is None:
+        with _tenants_lock:
+            if _tenants is None:
+                path = os.getenv('TENANTS_FILE')
+                if path:
+                    with open(path, encoding='utf-8') as f:
+                        configs = json.load(f)
+                    seen = {}
+                    for c in configs:
+                        db_name = c.get('db_name')
+                        if not db_name:
+                            raise ValueError(f"Tenant {c.get('name')} in {path} has no db_name")
+                        if db_name in seen:
+                            raise ValueError(f"Tenants {seen[db_name]} and {c.get('name')} in {path} share db_name {db_name}")
+                        seen[db_name] = c.get('name')
+                    tenants = [
+                        Tenant(
+                            c['name'], c['client_id'], c['client_secret'],
+                            process_codes=parse_process_codes(c.get('process_codes')),
+                            db_name=c['db_name'], qps=c.get('qps')
+                        )
+                        for c in configs
+                    ]
+                    logger.info(f"Loaded {len(tenants)} tenants from {path}: {', '.join(t.name for t in tenants)}")
+                else:
+                    tenants = [Tenant(
+                        'default',
+                        os.getenv('DINGTALK_CLIENT_ID', '').strip(),
+                        os.getenv('DINGTALK_CLIENT_SECRET', '').strip(),
+                        process_codes=parse_process_codes(os.getenv('PROCESS_CODE', ''))
+                    )]
+                _tenants = tenants
+    return _tenants
+
+def select_tenants(name=None):
+    """All tenants, or only the one named by `name` / the TENANT env var."""
+    name = name or os.getenv('TENANT')
+    tenants = load_tenants()
+    if not name:
+        return tenants
+    selected = [t for t in tenants if t.name == name]
+    if not selected:
+        raise ValueError(f"Unknown tenant: {name}")
+    return selected
+
+# --- Current tenant (per thread / asyncio task) ---
+
+_current = contextvars.ContextVar('tenant', default=None)
+
+def current_tenant():
+    """Tenant active in this context; the first selected tenant (see select_tenants) if none is active."""
+    return _current.get() or select_tenants()[0]
+
+def current_db_name():
+    """Target database of the active tenant."""
+    return current_tenant().db_name
+
+@contextmanager
+def use_tenant(tenant):
+    token = _current.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current.reset(token)
+
+def bind(fn, tenant=None):
+    """
+    Wrap `fn` so it runs in a copy of the caller's context (tenant, API priority) with
+    `tenant` (default: the caller's tenant) active. Needed for work handed to
+    threads/executors, which don't inherit the caller's context.
+    """
+    context = contextvars.copy_context()
+    tenant = tenant or _current.get()
+
+    def call(*args, **kwargs):
+        _current.set(tenant)
+        return fn(*args, **kwargs)
+
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so each call gets its own copy
+        return context.copy().run(call, *args, **kwargs)
+    return wrapper
+
+class TenantLogFilter:
+    """Adds the active tenant's name to every log record as `tenant`."""
+    def filter(self, record):
+        tenant = _current.get()
+        record.tenant = tenant.name if tenant else '-'
+        return True
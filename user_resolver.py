@@ -0,0 +1,104 @@
+import os
+import time
+import logging
+import threading
+
+from db import get_user_names_from_db, upsert_dingtalk_users
+
+logger = logging.getLogger(__name__)
+
+class UserResolver:
+    """
+    Read-through user name lookup: `dingtalk_user` table first, DingTalk API on miss.
+    - Concurrent syncs asking for the same missing user share one API call.
+    - Users found in DingTalk are written back to `dingtalk_user`.
+    - Confirmed-unknown IDs are remembered for USER_NEGATIVE_CACHE_TTL seconds.
+    """
+    def __init__(self, client_getter, negative_ttl=None, error_ttl=None):
+        self.client_getter = client_getter
+        self.negative_ttl = negative_ttl or int(os.getenv('USER_NEGATIVE_CACHE_TTL', 3600))
+        # Shorter back-off for API errors (permissions, rate limits) so we don't hammer DingTalk
+        self.error_ttl = error_ttl or min(self.negative_ttl, 300)
+        self._negative = {}  # userid -> expires_at
+        self._inflight = {}  # userid -> {'event': Event, 'name': str or None}
+        self._lock = threading.Lock()
+
+    def resolve(self, userids):
+        """
+        Resolve a collection of user IDs.
+        Returns: dict {userid: name} for the IDs that could be resolved.
+        """
+        userids = {u for u in userids if u}
+        if not userids:
+            return {}
+
+        try:
+            names = get_user_names_from_db(userids)
+        except Exception as e:
+            # Every ID would look like a miss; don't turn a DB outage into an API storm
+            logger.error(f"Error fetching user names, skipping DingTalk lookup: {e}")
+            return {}
+        misses = userids - set(names)
+        if not misses:
+            return names
+
+        now = time.time()
+        owned, waiting = [], {}
+        with self._lock:
+            for uid in misses:
+                if self._negative.get(uid, 0) > now:
+                    continue
+                entry = self._inflight.get(uid)
+                if entry:
+                    waiting[uid] = entry
+                else:
+                    self._inflight[uid] = {'event': threading.Event(), 'name': None}
+                    owned.append(uid)
+
+        if owned:
+            names.update(self._fetch(owned))
+
+        for uid, entry in waiting.items():
+            entry['event'].wait()
+            if entry['name']:
+                names[uid] = entry['name']
+
+        return names
+
+    def _fetch(self, userids):
+        """Fetch the IDs this thread owns, write back the hits and release the waiters."""
+        found = []
+        expiries = {}
+        try:
+            client = self.client_getter()
+            for uid in userids:
+                try:
+                    user = client.get_user_detail(uid)
+                except Exception as e:
+                    logger.warning(f"User lookup failed for {uid}: {e}")
+                    expiries[uid] = time.time() + self.error_ttl
+                    continue
+                if user and user.get('name'):
+                    found.append(user)
+                else:
+                    expiries[uid] = time.time() + self.negative_ttl
+
+            if found:
+                try:
+                    upsert_dingtalk_users(found)
+                except Exception as e:
+                    logger.warning(f"Failed to cache {len(found)} looked-up users: {e}")
+        finally:
+            names = {u['userid']: u['name'] for u in found}
+            with self._lock:
+                self._negative.update(expiries)
+                if len(self._negative) > 10000:
+                    now = time.time()
+                    self._negative = {u: exp for u, exp in self._negative.items() if exp > now}
+                for uid in userids:
+                    entry = self._inflight.pop(uid)
+                    entry['name'] = names.get(uid)
+                    entry['event'].set()
+        if found:
+            logger.info(f"Resolved {len(found)} new users from DingTalk.")
+        return names